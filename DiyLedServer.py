@@ -1,35 +1,677 @@
 import json
 import os
-import socketserver
 import threading
 import sys
-from multiprocessing import Process
 import logging
+import logging.handlers
 from uuid import getnode as get_mac
 import socket
 import struct
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import time
-import requests
+import heapq
+import random
+import contextlib
+import bisect
+import math
+import selectors
+import mmap
+import tempfile
+from array import array
+from collections import namedtuple, deque, OrderedDict
+from types import MappingProxyType
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote
+
+try:
+    import orjson  # optional, several times faster than the json module
+except ImportError:
+    orjson = None
 
 DEBUG = True
+STORAGE = "json"  # "json" or "sqlite", sqlite migrates an existing config.json on its first start
+STARTUP_BUDGET = 3.0  # seconds from process start to the first served /diyledstatus
 
-if DEBUG:
-    print("*------------------------------------------------*")
-    print("Starting server")
-    print("")
-    print("+ Setting up variables")
-config = None
+server = None
+sites = {}  # name -> Site, config, state, journal ... below forward to the site of the current thread
+siteHosts = {}  # host header -> Site
+defaultSite = None
+siteContext = threading.local()
 udp = None
+scheduler = None
+eventStream = None
+frameStream = None
+appNotifier = None
+replication = None  # ReplicationPrimary when standbys may follow this server
+standby = None  # ReplicationStandby while this server follows a primary
+tracer = None
+workerPool = None
+traceContext = threading.local()
+requests = None  # imported on first use, see getRequests()
+numpy = None  # optional, imported on first use, see getNumpy()
 
 MCAST_GRP = '239.255.255.250'
 MCAST_PORT = 1900
 MULTICAST_TTL = 2
 
-rooms = {}
-lights = {}
-scenes = {}
-appInstances = {}
+LIGHT_TIMEOUT = 5  # seconds to wait for a light to answer a request
+
+APP_PORT = 7777  # udp port the apps receive their notifications on
+APP_TIMEOUT = 600  # seconds without a request before an app counts as dead and gets no more notifications
+APP_PRUNE_AFTER = 86400  # seconds after its last request a dead app is forgotten
+APP_SWEEP_INTERVAL = 60
+
+SEARCH_WINDOW = 30  # seconds a discovery stays open for answers
+SEARCH_RETRIES = 2  # M-SEARCH datagrams per discovery, UDP might drop one
+SEARCH_RETRY_INTERVAL = 1
+
+RECONCILE_WORKERS = 8  # lights fetched at the same time while the known lights are reconciled at startup
+RECONCILE_TIMEOUT = 2  # seconds a known light has to answer before it is asked again or counts as unreachable
+RECONCILE_RETRIES = 2
+
+ROOM_GROUP_PREFIX = '239.255.77.'  # rooms get their multicast address out of this /24
+ROOM_GROUP_PORT = 7778
+GROUP_ACK_TIMEOUT = 0.5  # seconds a light has to ack a room datagram before it gets a unicast request
+GROUP_MAX_DATAGRAM = 1400
+
+JOURNAL_COMPACT_INTERVAL = 600  # seconds between rewrites of the state journal
+REQUEST_CACHE_SIZE = 256  # answers per site kept for apps that retry a request
+REQUEST_CACHE_TTL = 10  # seconds a retry gets the answer of the first request
+REQUEST_CACHE_WAIT = 30  # seconds a retry waits for the first request if that is still running
+HISTORY_SIZE = 512  # state changes per light kept in memory
+HISTORY_RECENT = 3600  # seconds of changes kept in memory before they are summed up in the history file
+HISTORY_ARCHIVE_INTERVAL = 600  # seconds between moving changes into the history file
+HISTORY_BUCKET = 900  # seconds summed up in one entry of the history file
+HISTORY_BUCKETS = 8832  # entries per light in the history file, 92 days
+OUTBOX_FLUSH_DELAY = 1  # seconds after a registration before a light gets the changes it missed
+
+EVENT_BACKLOG = 1024  # events kept for clients that reconnect to /diyledevents
+EVENT_KEEPALIVE = 15  # seconds of silence before idle streams get a comment
+EVENT_MAX_PENDING = 256 * 1024  # bytes a slow client may fall behind before it gets disconnected
+EVENT_RETRY = 2000  # milliseconds a client waits before reconnecting
+
+FRAME_PORT = 4048  # DDP port the lights receive pixel data on
+FRAME_INGEST_PORT = 7780  # udp port the server receives raw frames for the lights on
+FRAME_MAX_DATA = 1440  # pixel bytes per DDP datagram, 480 RGB pixels
+
+REPLICATION_PORT = 7779  # tcp port a primary streams its changes to standbys on
+REPLICATION_HEARTBEAT = 1  # seconds between heartbeats of an idle primary
+REPLICATION_TIMEOUT = 5  # seconds without a word from the primary before a standby takes over
+REPLICATION_BACKLOG = 10000  # changes kept for standbys that reconnect
+
+TRACE_SAMPLE_RATE = 0.01  # share of the requests that get traced, 0 turns tracing off
+TRACE_BUFFER = 256  # finished traces kept for /diyledtraces
+TRACE_FILE = None  # e.g. "traces.jsonl" to also write every trace to a file
+TRACE_FILE_SIZE = 5 * 1024 * 1024  # bytes before the trace file is rotated
+TRACE_FILE_COUNT = 3  # rotated trace files kept
+
+HTTP_WORKERS = 8  # threads handling http requests
+HTTP_RESERVED_WORKERS = 2  # workers kept free for interactive requests, bulk work never gets them
+HTTP_QUEUE_SIZE = 64  # requests waiting in a lane before new ones get a 503
+HTTP_MAX_CONNECTIONS = 256  # connections that have not sent their request yet
+HTTP_SORT_WAIT = 0.1  # seconds to wait for the rest of a request that arrives in pieces
+HTTP_IDLE_TIMEOUT = 10  # seconds a new connection may stay silent before it gets closed
+HTTP_PEEK_SIZE = 4096  # bytes of a request looked at to pick its lane
+HTTP_WAIT_SAMPLES = 1024  # queue times per lane kept for the percentiles
+HTTP_REJECT = b"HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n\r\n"
+
+groupCommands = {}
+groupLock = threading.Lock()
+groupCounter = 0
+
+
+def getRequests():
+    # requests takes longer to import than the rest of the server needs to start
+    global requests
+    if requests is None:
+        import requests as requestsModule
+        requests = requestsModule
+    return requests
+
+
+def getNumpy():
+    # numpy is optional and takes a while to import, without it the history queries fall back to plain loops
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as numpyModule
+            numpy = numpyModule
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+
+def putLight(light, action, jsonData):
+    # every request to a light goes through here, its outcome is the health of the light
+    try:
+        with span("light", light=light.name, action=action):
+            response = getRequests().put("http://" + light.ip + ":80/diyledapi/" + str(hex(get_mac())) + "/" + action,
+                                         data=jsonDumps(jsonData), timeout=LIGHT_TIMEOUT)
+    except Exception:
+        light.failures = light.failures + 1
+        outbox.defer(light, LightOutbox.getKeys(jsonData["id"], jsonData["data"]))
+        lightIndex.update(light)
+        state.touch()
+        raise
+    light.failures = 0
+    light.lastSeen = time.time()
+    outbox.delivered(light, LightOutbox.getKeys(jsonData["id"], jsonData["data"]))
+    lightIndex.update(light)
+    state.touch()  # health and lastSeen are part of the status pages
+    return response
+
+
+def putLightValue(light, jsonData):
+    # the answer of the light, None if it couldn't be reached: the outbox keeps the value until it is back
+    try:
+        response = putLight(light, "updateValue", jsonData)
+    except Exception as e:
+        if DEBUG:
+            print("HTTP: couldn't reach " + light.name)
+            print(e)
+        return None
+    return jsonLoads(response.content)
+
+
+def getQueuedPacket(jsonData):
+    # the server took the value, the light gets it with its next registration
+    return {
+        "id": "successPacket",
+        "data": {
+            "message": "Licht nicht erreichbar, der Wert wird nachgeholt.",
+            "queued": True,
+            "id": jsonData["data"]["id"]
+        }
+    }
+
+
+def lightChanged(light):
+    journal.record(light)
+    history.record(light)
+    replicate("light", lightRecord(light))
+    lightIndex.update(light)
+    countLight(light)
+    state.touch()
+    events.publish("light", light.getInfoPacket()["data"])
+
+
+# -- tracing, a sampled share of the requests records a tree of timed spans
+class Span():
+    __slots__ = ("name", "attributes", "start", "duration", "error", "children")
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.duration = None
+        self.error = None
+        self.children = []
+
+    def finish(self, error=None):
+        self.duration = time.perf_counter() - self.start
+        if error is not None:
+            self.error = repr(error)
+
+    def toJson(self, origin):
+        data = {"name": self.name, "start": round((self.start - origin) * 1000, 3),
+                "duration": round(self.duration * 1000, 3)}
+        if self.attributes:
+            data["attributes"] = self.attributes
+        if self.error is not None:
+            data["error"] = self.error
+        if self.children:
+            data["children"] = [child.toJson(origin) for child in self.children]
+        return data
+
+
+class SpanScope():
+    # costs one thread local lookup when the current request is not traced
+    __slots__ = ("name", "attributes", "parent", "span")
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+
+    def __enter__(self):
+        self.parent = getattr(traceContext, "span", None)
+        if self.parent is not None:
+            self.span = Span(self.name, self.attributes)
+            self.parent.children.append(self.span)
+            traceContext.span = self.span
+        return self.span
+
+    def __exit__(self, kind, error, tb):
+        if self.span is not None:
+            self.span.finish(error)
+            traceContext.span = self.parent
+        return False
+
+
+class TraceScope(SpanScope):
+    __slots__ = ("force", "traceId")
+
+    def __init__(self, name, attributes, force):
+        super().__init__(name, attributes)
+        self.force = force
+        self.traceId = None
+
+    def __enter__(self):
+        self.parent = getattr(traceContext, "span", None)
+        if tracer is not None and self.parent is None and (self.force or tracer.sample()):
+            self.span = Span(self.name, self.attributes)
+            self.traceId = "%016x" % random.getrandbits(64)
+            traceContext.span = self.span
+            traceContext.traceId = self.traceId
+        return self.span
+
+    def __exit__(self, kind, error, tb):
+        if self.span is not None:
+            self.span.finish(error)
+            traceContext.span = None
+            traceContext.traceId = None
+            tracer.finish(self.traceId, self.span)
+        return False
+
+
+def span(name, **attributes):
+    return SpanScope(name, attributes)
+
+
+def trace(name, force=False, **attributes):
+    return TraceScope(name, attributes, force)
+
+
+class Tracer():
+    # finished traces go into a ring buffer for /diyledtraces and, if a path is given, into a rotating jsonl file
+    def __init__(self, rate, path=None):
+        self.rate = rate
+        self.traces = deque(maxlen=TRACE_BUFFER)
+        self.sampled = 0
+        self.logger = None
+        if path is not None:
+            self.logger = logging.getLogger("diyled.trace")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=TRACE_FILE_SIZE,
+                                                           backupCount=TRACE_FILE_COUNT)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self.logger.addHandler(handler)
+
+    def sample(self):
+        return self.rate > 0 and random.random() < self.rate
+
+    def finish(self, traceId, root):
+        data = root.toJson(root.start)
+        data["trace"] = traceId
+        data["time"] = time.time() - root.duration
+        data["site"] = currentSite().name if currentSite() is not None else None
+        self.traces.append(data)
+        self.sampled = self.sampled + 1
+        if self.logger is not None:
+            self.logger.info(jsonDumps(data).decode('utf-8'))
+
+    def getTraces(self, limit):
+        traces = list(self.traces)
+        traces.reverse()
+        return {"rate": self.rate, "sampled": self.sampled, "traces": traces[:limit]}
+
+
+# -- JSON codec, every request, response, light command and app message goes through these
+def jsonDumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return jsonDumpsFallback(data)
+
+
+def jsonLoads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return jsonLoadsFallback(data)
+
+
+def jsonDumpsFallback(data):
+    # without orjson, compact like orjson so both produce the same bytes for the apps
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode('utf-8')
+
+
+def jsonLoadsFallback(data):
+    return json.loads(data)
+
+
+def readJson(handler):
+    content_len = int(handler.headers.get('Content-Length', 0))
+    with span("parse", bytes=content_len):
+        return jsonLoads(handler.rfile.read(content_len))
+
+
+def sendJson(handler, jsonReturn):
+    with span("respond"):
+        body = jsonDumps(jsonReturn)
+        handler.send_response(200)
+        handler.send_header('Content-type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        if getattr(traceContext, "traceId", None) is not None:
+            handler.send_header('X-DiyLed-Trace', traceContext.traceId)
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def getProcessStartTime():
+    # wall clock time the process (e.g. the systemd service) was started, falls back to now
+    try:
+        with open("/proc/self/stat", "r") as file:
+            startTicks = int(file.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat", "r") as file:
+            for line in file:
+                if line.startswith("btime"):
+                    return int(line.split()[1]) + startTicks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        pass
+    return time.time()
+
+
+class ScheduledCall():
+    __slots__ = ("deadline", "callback", "args", "site", "cancelled")
+
+    def __init__(self, deadline, callback, args, site):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.site = site  # the callback runs for the site that scheduled it
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler():
+    # one thread, one heap: every timer of the server (discovery windows, retries, probes,
+    # user schedules) lives in here, adding or cancelling a timer costs O(log n)
+    def __init__(self):
+        self.queue = []
+        self.counter = 0
+        self.cancelled = 0
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def callLater(self, delay, callback, *args):
+        call = ScheduledCall(time.monotonic() + delay, callback, args, currentSite())
+        with self.condition:
+            self.counter = self.counter + 1
+            heapq.heappush(self.queue, (call.deadline, self.counter, call))
+            if self.queue[0][2] is call:
+                self.condition.notify()
+        return call
+
+    def callAt(self, timestamp, callback, *args):
+        # timestamp is wall clock time, the heap itself runs on the monotonic clock
+        return self.callLater(max(0, timestamp - time.time()), callback, *args)
+
+    def cancel(self, call):
+        if call is None or call.cancelled:
+            return
+        with self.condition:
+            call.cancel()
+            self.cancelled = self.cancelled + 1
+            # cancelled calls are dropped lazily, rebuild the heap once they make up half of it
+            if self.cancelled > 64 and self.cancelled * 2 > len(self.queue):
+                self.queue = [entry for entry in self.queue if not entry[2].cancelled]
+                heapq.heapify(self.queue)
+                self.cancelled = 0
+
+    def pending(self):
+        with self.condition:
+            return len(self.queue) - self.cancelled
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.queue:
+                        self.condition.wait()
+                        continue
+                    deadline, counter, call = self.queue[0]
+                    if call.cancelled:
+                        heapq.heappop(self.queue)
+                        self.cancelled = max(0, self.cancelled - 1)
+                        continue
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        heapq.heappop(self.queue)
+                        call.cancelled = True
+                        break
+                    self.condition.wait(timeout)
+            try:
+                with activeSite(call.site):
+                    call.callback(*call.args)
+            except Exception as e:
+                logging.exception("SCHEDULER: error in timer callback")
+                if DEBUG:
+                    print("SCHEDULER: error in timer callback")
+                    print(e)
+
+
+StateSnapshot = namedtuple("StateSnapshot", ["version", "lights", "rooms", "scenes", "schedules", "appInstances"])
+
+
+class StateStore():
+    # the dicts are never changed in place: a writer copies, changes and publishes a new snapshot under the
+    # lock, readers just take the current snapshot and never wait for a writer. A snapshot is shallow, which
+    # names it holds never changes, but the lights, rooms ... in it are shared and still change (see touch)
+    KINDS = ("lights", "rooms", "scenes", "schedules", "appInstances")
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = dict((kind, {}) for kind in self.KINDS)
+        self.current = None
+        self.publish(0)
+
+    def publish(self, version):
+        views = [MappingProxyType(self.items[kind]) for kind in self.KINDS]
+        self.current = StateSnapshot(version, *views)
+
+    def snapshot(self):
+        return self.current
+
+    @property
+    def version(self):
+        return self.current.version
+
+    @property
+    def lights(self):
+        return self.current.lights
+
+    @property
+    def rooms(self):
+        return self.current.rooms
+
+    @property
+    def scenes(self):
+        return self.current.scenes
+
+    @property
+    def schedules(self):
+        return self.current.schedules
+
+    @property
+    def appInstances(self):
+        return self.current.appInstances
+
+    def replace(self, kind, items):
+        with self.lock:
+            self.items[kind] = items
+            self.publish(self.current.version + 1)
+
+    def put(self, kind, name, value):
+        with self.lock:
+            items = self.items[kind].copy()
+            items[name] = value
+            self.items[kind] = items
+            self.publish(self.current.version + 1)
+
+    def remove(self, kind, name):
+        with self.lock:
+            items = self.items[kind].copy()
+            value = items.pop(name, None)
+            self.items[kind] = items
+            self.publish(self.current.version + 1)
+        return value
+
+    def touch(self):
+        # for changes inside of an object (power, brightness ...), lets cached views know they are stale
+        with self.lock:
+            self.publish(self.current.version + 1)
+
+
+def getSunTime(day, latitude, longitude, rising):
+    # sunrise equation from the Almanac for Computers, accurate to about a minute
+    zenith = 90.833
+    lngHour = longitude / 15
+    t = day.timetuple().tm_yday + ((6 if rising else 18) - lngHour) / 24
+    M = (0.9856 * t) - 3.289
+    L = (M + 1.916 * math.sin(math.radians(M)) + 0.020 * math.sin(math.radians(2 * M)) + 282.634) % 360
+    RA = math.degrees(math.atan(0.91764 * math.tan(math.radians(L)))) % 360
+    RA = (RA + (math.floor(L / 90) * 90) - (math.floor(RA / 90) * 90)) / 15
+    sinDec = 0.39782 * math.sin(math.radians(L))
+    cosDec = math.cos(math.asin(sinDec))
+    cosH = (math.cos(math.radians(zenith)) - sinDec * math.sin(math.radians(latitude))) / (
+            cosDec * math.cos(math.radians(latitude)))
+    if cosH > 1 or cosH < -1:  # the sun doesn't rise or set on that day
+        return None
+    H = math.degrees(math.acos(cosH))
+    if rising:
+        H = 360 - H
+    T = H / 15 + RA - (0.06571 * t) - 6.622
+    UT = (T - lngHour) % 24
+    sunTime = datetime(day.year, day.month, day.day, tzinfo=timezone.utc) + timedelta(hours=UT)
+    # UT is only the time of day, far from greenwich the event of this day falls on the UTC day before or after.
+    # The local solar time at the longitude tells which one it is
+    solarDay = (sunTime + timedelta(hours=lngHour)).date()
+    if solarDay < day:
+        sunTime = sunTime + timedelta(days=1)
+    elif solarDay > day:
+        sunTime = sunTime - timedelta(days=1)
+    return sunTime
+
+
+class Schedule():
+    global config
+    global scheduler
+
+    def __init__(self, name, at, offset, days, action):
+        self.name = name
+        self.at = at  # "HH:MM", "sunrise" or "sunset"
+        self.offset = offset  # minutes
+        self.days = days  # weekdays, 0 = monday, empty for every day
+        self.action = action
+        self.timer = None
+        self.nextRun = None
+
+    def getRunTime(self, day):
+        if self.at == "sunrise" or self.at == "sunset":
+            latitude = config.config["server"].get("latitude")
+            longitude = config.config["server"].get("longitude")
+            if latitude is None or longitude is None:
+                return None
+            sunTime = getSunTime(day, float(latitude), float(longitude), self.at == "sunrise")
+            if sunTime is None:
+                return None
+            runTime = sunTime.timestamp()
+        else:
+            hour, minute = self.at.split(":")
+            runTime = datetime(day.year, day.month, day.day, int(hour), int(minute)).timestamp()
+        return runTime + int(self.offset) * 60
+
+    def validate(self):
+        # raises ValueError for a schedule that can't be armed, before it is saved
+        if self.at != "sunrise" and self.at != "sunset":
+            parts = self.at.split(":")
+            if len(parts) != 2:
+                raise ValueError("time has to be HH:MM, sunrise or sunset: " + self.at)
+            hour, minute = parts
+            if not (0 <= int(hour) < 24 and 0 <= int(minute) < 60):
+                raise ValueError("time out of range: " + self.at)
+        if any(day < 0 or day > 6 for day in self.days):
+            raise ValueError("days have to be between 0 (monday) and 6 (sunday)")
+        if abs(self.offset) > 24 * 60:
+            raise ValueError("offset of more than a day: " + str(self.offset))
+        if not isinstance(self.action, dict):
+            raise ValueError("action has to be an object")
+        self.getNextRun(time.time())
+
+    def getNextRun(self, now):
+        today = datetime.fromtimestamp(now).date()
+        for i in range(8):
+            day = today + timedelta(days=i)
+            if self.days and day.weekday() not in self.days:
+                continue
+            runTime = self.getRunTime(day)
+            if runTime is not None and runTime > now:
+                return runTime
+        return None
+
+    def arm(self, after=None):
+        scheduler.cancel(self.timer)
+        self.nextRun = self.getNextRun(time.time() if after is None else max(time.time(), after))
+        if self.nextRun is None:
+            self.timer = None
+            if DEBUG:
+                print("SCHEDULER: schedule " + self.name + " has no next run")
+            return
+        self.timer = scheduler.callAt(self.nextRun, self.run)
+
+    def disarm(self):
+        scheduler.cancel(self.timer)
+        self.timer = None
+        self.nextRun = None
+
+    def run(self):
+        # the action puts to every light of a room or scene, that runs on its own thread so the other timers
+        # don't wait for it
+        t = threading.Thread(target=self.execute, args=(currentSite(),))
+        t.daemon = True
+        t.start()
+        self.arm(self.nextRun)
+
+    def execute(self, site):
+        if DEBUG:
+            print("SCHEDULER: running schedule " + self.name)
+        jsonData = {
+            "id": "changeValueRequestPacket",
+            "data": dict(self.action)
+        }
+        jsonData["data"]["id"] = hex(get_mac())
+        try:
+            with activeSite(site), trace("schedule " + self.name):
+                handleRequest(jsonData, None, ISUDP=True)
+                notifyApps()
+        except Exception as e:
+            logging.exception("SCHEDULER: schedule " + self.name + " failed")
+            if DEBUG:
+                print("SCHEDULER: schedule " + self.name + " failed")
+                print(e)
+
+    def getInfoPacket(self):
+        data = {
+            "id": "schedulePacket",
+            "data": {
+                "name": self.name,
+                "time": self.at,
+                "offset": self.offset,
+                "days": self.days,
+                "action": self.action,
+                "nextRun": self.nextRun
+            }
+        }
+        return data
 
 
 class AppInstance():
@@ -37,86 +679,234 @@ class AppInstance():
         self.ip = ip
         self.DISCOVER = False
         self.DEAD = False
+        self.lastSeen = time.time()  # every request of the app is a heartbeat
+
+    def seen(self):
+        # True if the app was dead and is back
+        self.lastSeen = time.time()
+        if self.DEAD:
+            self.DEAD = False
+            return True
+        return False
+
+    def sendMessage(self, payload):
+        appNotifier.send(payload, [self])
+
+
+def registerApp(ip):
+    app = state.appInstances.get(ip)
+    if app is None:
+        app = AppInstance(ip)
+        state.put("appInstances", ip, app)
+    elif app.seen():
+        state.touch()
+    return app
+
+
+def appSeen(ip):
+    app = state.appInstances.get(ip)
+    if app is not None and app.seen():
+        state.touch()
+
+
+def sweepApps():
+    # apps are closed or the phone left the wifi without telling anyone, they stop sending requests
+    try:
+        now = time.time()
+        snapshot = state.snapshot()
+        changed = False
+        for ip in snapshot.appInstances:
+            app = snapshot.appInstances[ip]
+            if now - app.lastSeen > APP_PRUNE_AFTER:
+                state.remove("appInstances", ip)
+            elif now - app.lastSeen > APP_TIMEOUT and not app.DEAD:
+                app.DEAD = True
+                changed = True
+        if changed:
+            state.touch()
+    finally:
+        scheduler.callLater(APP_SWEEP_INTERVAL, sweepApps)
+
+
+class AppNotifier():
+    # the udp notifications of all sites go out from one thread, the request that caused them doesn't wait for
+    # them. Notifications that pile up meanwhile are merged, an app gets every payload once per pass
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()  # payload -> {ip: AppInstance}
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def send(self, payload, apps):
+        if not apps:
+            return
+        with self.condition:
+            targets = self.pending.get(payload)
+            if targets is None:
+                targets = {}
+                self.pending[payload] = targets
+            for app in apps:
+                if app.ip in targets:
+                    self.merged = self.merged + 1
+                targets[app.ip] = app
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                pending = self.pending
+                self.pending = OrderedDict()
+            sent = 0
+            failed = 0
+            for payload in pending:
+                for ip in pending[payload]:
+                    try:
+                        udp.sendto(payload, socket.MSG_DONTWAIT, (ip, APP_PORT))
+                        sent = sent + 1
+                    except OSError:
+                        failed = failed + 1  # the app fetches everything again with its next request
+            with self.condition:
+                self.sent = self.sent + sent
+                self.failed = self.failed + failed
+
+    def getMetrics(self):
+        with self.condition:
+            return {"sent": self.sent, "merged": self.merged, "failed": self.failed}
+
+def countLight(light):
+    # moves the difference to what the light counted for before into the aggregates of its rooms, so a change
+    # costs one step per room of the light instead of a look at every light of these rooms
+    with state.lock:
+        rooms = [state.rooms.get(roomName) for roomName in light.rooms]  # lazily loaded rooms count the old values
+        counted = light.counted
+        contribution = light.getContribution()
+        if contribution == counted:
+            return
+        light.counted = contribution
+        for room in rooms:
+            if room is not None and room.addCounts(contribution[0] - counted[0], contribution[1] - counted[1]):
+                events.publish("room", room.getInfoPacket()["data"])
 
-    def sendMessage(self, message):
-        global udp
-        udp.sendto(message.encode('utf-8'), (self.ip, 7777))
 
 class Room():
     global config
-    global lights
-    global scenes
 
-    def __init__(self, name, lights, scenes):
+    def __init__(self, name, lights, scenes, group=None):
         self.name = name
-        self.lights = lights
+        self.lights = lights  # ordered as the apps show them, lightNames is for lookups
+        self.lightNames = frozenset(lights)
         self.scenes = scenes
+        self.group = group  # multicast address the lights of this room listen on, None for unicast only
         self.power = False
+        self.lightsOn = 0
+        self.brightnessOn = 0  # sum of the brightness of the lights that are on
 
     def addLight(self, light):
-        self.lights.append(light.name)
-        if light.power:
-            self.power = True
-        config.updateRoom(self)
+        self.lights = self.lights + [light.name]
+        self.lightNames = self.lightNames | {light.name}
+        self.addCounts(*light.counted)
+        self.changed()
 
     def removeLight(self, light):
-        del self.lights[self.lights.index(light.name)]
-        self.power = False
-        for lightName in self.lights:
-            if lights[lightName].power:
-                self.power = True
-        config.updateRoom(self)
+        self.lights = [name for name in self.lights if name != light.name]
+        self.lightNames = self.lightNames - {light.name}
+        self.addCounts(-light.counted[0], -light.counted[1])
+        self.changed()
+
+    def addCounts(self, lightsOn, brightnessOn):
+        # True if the power of the room changed, it is on as long as one of its lights is
+        self.lightsOn = self.lightsOn + lightsOn
+        self.brightnessOn = self.brightnessOn + brightnessOn
+        if (self.lightsOn > 0) != self.power:
+            self.power = self.lightsOn > 0
+            return True
+        return False
 
     def addScene(self, scene):
-        self.scenes.append(scene)
-        config.updateRoom(self)
+        self.scenes = self.scenes + [scene]
+        self.changed()
 
     def removeScene(self, scene):
-        del self.scenes[self.scenes.index(scene.name)]
+        self.scenes = [name for name in self.scenes if name != scene.name]
+        self.changed()
+
+    def setGroup(self, group):
+        self.group = group
+        self.changed()
+
+    def changed(self):
         config.updateRoom(self)
+        events.publish("room", self.getInfoPacket()["data"])
 
     def applyScene(self, scene):
-        scenes[scene].applyScene()
+        state.scenes[scene].applyScene()
 
     def togglePower(self, newPowerState):
-        self.power = newPowerState
         for lightName in self.lights:
-            lights[lightName].power = self.power
-            jsonData = {
-                "id": "changeValueRequestPacket",
-                "data": {
-                    "request": "light",
-                    "name": lightName,
-                    "key": "power",
-                    "value": str(self.power).lower(),
-                    "id": hex(get_mac())
-                }
-            }
-            print(json.dumps(jsonData))
-            requests.put("http://" + lights[lightName].ip + ":80/diyledapi/" + str(hex(get_mac())) + "/updateValue",
-                         data=json.dumps(jsonData).encode('utf-8'))
+            state.lights[lightName].power = newPowerState
+            lightChanged(state.lights[lightName])
+        if self.power != newPowerState:  # a room without lights
+            self.power = newPowerState
+            events.publish("room", self.getInfoPacket()["data"])
+        self.sendValue("power", str(self.power).lower())
 
     def setRoomBrightness(self, newBrightness):
         for lightName in self.lights:
-            lights[lightName].brightness = newBrightness
-            jsonData = {
-                "id": "changeValueRequestPacket",
-                "data": {
-                    "request": "light",
-                    "name": lightName,
-                    "key": "brightness",
-                    "value": int(newBrightness),
-                    "id": hex(get_mac())
-                }
+            state.lights[lightName].brightness = newBrightness
+            lightChanged(state.lights[lightName])
+        self.sendValue("brightness", int(newBrightness))
+
+    def sendValue(self, key, value):
+        data = {
+            "request": "room",
+            "name": self.name,
+            "key": key,
+            "value": value
+        }
+        if sendGroupCommand(self, "changeValueRequestPacket", data,
+                            lambda lightName: self.sendLightValue(lightName, key, value)):
+            return
+        for lightName in self.lights:
+            try:
+                self.sendLightValue(lightName, key, value)
+            except Exception as e:  # the light gets the value from its outbox once it is back
+                if DEBUG:
+                    print("HTTP: couldn't reach " + lightName)
+                    print(e)
+
+    def sendLightValue(self, lightName, key, value):
+        jsonData = {
+            "id": "changeValueRequestPacket",
+            "data": {
+                "request": "light",
+                "name": lightName,
+                "key": key,
+                "value": value,
+                "id": hex(get_mac())
             }
-            requests.put("http://" + lights[lightName].ip + ":80/diyledapi/" + str(hex(get_mac())) + "/updateValue",
-                         data=json.dumps(jsonData).encode('utf-8'))
+        }
+        if DEBUG:
+            print(json.dumps(jsonData))
+        putLight(state.lights[lightName], "updateValue", jsonData)
 
     def updatePowerState(self):
-        self.power = False
+        # counts the aggregates from scratch when the room is loaded, afterwards countLight keeps them up to date
+        self.lightsOn = 0
+        self.brightnessOn = 0
         for light in self.lights:
-            if lights[light].power:
-                self.power = True
+            on, brightness = state.lights[light].counted
+            self.lightsOn = self.lightsOn + on
+            self.brightnessOn = self.brightnessOn + brightness
+        if self.addCounts(0, 0):
+            events.publish("room", self.getInfoPacket()["data"])
 
     def getInfoPacket(self):
         data = {
@@ -125,7 +915,10 @@ class Room():
                 "name": self.name,
                 "lights": self.lights,
                 "power": self.power,
-                "scenes": self.scenes
+                "lightsOn": self.lightsOn,
+                "averageBrightness": self.brightnessOn / self.lightsOn if self.lightsOn else 0,
+                "scenes": self.scenes,
+                "group": self.group
             }
         }
         return data
@@ -141,19 +934,52 @@ class Light():
         self.power = power
         self.modes = modes
         self.ip = ip
+        self.lastSeen = None
+        self.failures = 0  # failed requests in a row
+        self.roomNames = frozenset(rooms)
+        self.counted = self.getContribution()  # (on, brightness while on) as its rooms count it
 
     def addRoom(self, room):
-        self.rooms.append(room.name)
+        self.rooms = self.rooms + [room.name]
+        self.roomNames = self.roomNames | {room.name}
         config.updateLight(self)
 
     def removeRoom(self, room):
-        del self.rooms[self.rooms.index(room.name)]
+        self.rooms = [name for name in self.rooms if name != room.name]
+        self.roomNames = self.roomNames - {room.name}
         config.updateLight(self)
 
+    def getContribution(self):
+        if self.power:
+            return (1, int(self.brightness))
+        return (0, 0)
+
     def togglePower(self, newPowerState):
         self.power = newPowerState
 
-    def getInfoPacket(self):
+    def getStatePacket(self):
+        data = {
+            "id": "applyScenePacket",
+            "data": {
+                "color": [self.color.r, self.color.g, self.color.b],
+                "brightness": self.brightness,
+                "mode": self.mode,
+                "power": str(self.power).lower(),
+                "id": hex(get_mac())
+            }
+        }
+        return data
+
+    def getHealth(self):
+        if self.failures > 0:
+            return "unreachable"
+        if self.lastSeen is None:
+            return "unknown"
+        return "online"
+
+    def getInfoPacket(self, fields=None):
+        if fields is not None:
+            return {"id": "lightPacket", "data": dict((field, LIGHT_FIELDS[field](self)) for field in fields)}
         data = {
             "id": "lightPacket",
             "data": {
@@ -169,8 +995,20 @@ class Light():
         }
         return data
 
+LIGHT_FIELDS = {
+    "name": lambda l: l.name,
+    "rooms": lambda l: l.rooms,
+    "color": lambda l: [l.color.r, l.color.g, l.color.b],
+    "brightness": lambda l: l.brightness,
+    "mode": lambda l: l.mode,
+    "power": lambda l: l.power,
+    "ledCount": lambda l: l.ledCount,
+    "modes": lambda l: l.modes,
+    "health": lambda l: l.getHealth(),
+    "lastSeen": lambda l: l.lastSeen
+}
+
 class Scene():
-    global lights
 
     def __init__(self, name, room, lightStates):
         self.name = name
@@ -186,28 +1024,50 @@ class Scene():
     def applyScene(self):
         if DEBUG:
             print("SERVER: applying Scene: " + self.name + " of " + self.room + " for " + str(
-                len(lightStates)) + " lights")
+                len(self.lightStates)) + " lights")
+        groupStates = {}
         for light in self.lightStates:
-            l = lights[light]
+            l = state.lights[light]
             stateJson = self.lightStates[light]
             l.color = stateJson["color"]
             l.brightness = int(stateJson["brightness"])
             l.mode = str(stateJson["mode"])
             l.power = json.loads(str(stateJson["power"]).lower())
-            jsonData = {
-                "id": "applyScenePacket",
-                "data": {
-                    "color": [l.color.r, l.color.g, l.color.b],
-                    "brightness": l.brightness,
-                    "mode": l.mode,
-                    "power": str(l.power).lower(),
-                    "id": hex(get_mac())
-                }
+            lightChanged(l)
+            groupStates[light] = {
+                "color": [l.color.r, l.color.g, l.color.b],
+                "brightness": l.brightness,
+                "mode": l.mode,
+                "power": str(l.power).lower()
             }
-            requests.put("http://" + l.ip + ":80/diyledapi/" + str(hex(get_mac())) + "/applyScene",
-                         data=json.dumps(jsonData).encode('utf-8'))
+        # only lights of the room listen on its group, the others of the scene can't ack and get their state
+        # right away
+        room = state.rooms.get(self.room)
+        members = [light for light in self.lightStates if room is not None and light in room.lightNames]
+        unicast = [light for light in self.lightStates if light not in members]
+        data = {
+            "request": "scene",
+            "name": self.name,
+            "room": self.room,
+            "lightStates": dict((light, groupStates[light]) for light in members)
+        }
+        if not members or not sendGroupCommand(room, "applyScenePacket", data, self.sendLightState, members):
+            unicast = list(self.lightStates)
+        for light in unicast:
+            try:
+                self.sendLightState(light)
+            except Exception as e:  # the light gets its state from its outbox once it is back
+                if DEBUG:
+                    print("HTTP: couldn't reach " + light)
+                    print(e)
 
-    def getInfoPacket(self):
+    def sendLightState(self, light):
+        l = state.lights[light]
+        putLight(l, "applyScene", l.getStatePacket())
+
+    def getInfoPacket(self, fields=None):
+        if fields is not None and "lightStates" not in fields:  # the light states are the expensive part
+            return {"id": "scenePacket", "data": dict((field, getattr(self, field)) for field in fields)}
         lightStateJsons = []
         for lightState in self.lightStates:
             ls = self.lightStates[lightState]
@@ -228,6 +1088,8 @@ class Scene():
                 "lightStates": lightStateJsons
             }
         }
+        if fields is not None:
+            data["data"] = dict((field, data["data"][field]) for field in fields)
         return data
 
 class LedColor():
@@ -238,8 +1100,6 @@ class LedColor():
 
 
 class Config():
-    global lights
-    global rooms
 
     def __init__(self, path):
         self.path = path
@@ -247,7 +1107,7 @@ class Config():
         self.load()
 
     # -- CONFIG functions
-    def createDefault(self):
+    def getDefault(self):
         data = {
             "server": {
                 "ip": "localhost",
@@ -261,8 +1121,13 @@ class Config():
             },
             "rooms": [],
             "lights": [],
-            "scenes": []
+            "scenes": [],
+            "schedules": []
         }
+        return data
+
+    def createDefault(self):
+        data = self.getDefault()
         with open(self.path, "w") as file:
             json.dump(data, file)
 
@@ -275,14 +1140,28 @@ class Config():
         else:
             with open(self.path, "r") as file:
                 self.config = json.load(file)
+            self.config.setdefault("schedules", [])
         self.configLoaded = True
         logging.info('CONFIG: Loaded')
 
     def save(self):
-        with open(self.path, "w") as file:
+        with span("config.save"), open(self.path, "w") as file:
             json.dump(self.config, file)
         logging.info('CONFIG: Saved')
 
+    def getData(self):
+        return self.config
+
+    def replaceData(self, data):
+        self.config = data
+        self.config.setdefault("schedules", [])
+        self.save()
+
+    def exportJson(self, path):
+        with open(path, "w") as file:
+            json.dump(self.getData(), file)
+        logging.info('CONFIG: Exported to ' + path)
+
     # -- LIGHT functions
     def getLights(self):
         cLights = {}
@@ -305,11 +1184,10 @@ class Config():
     def removeLight(self, light):
         for i in range(len(self.config["lights"])):
             if self.config["lights"][i]["name"] == light.name:
-                for room in light.rooms:
-                    rooms[room].removeLight(light.name)
                 del self.config["lights"][i]
                 break
-        del lights[light.name]
+        state.remove("lights", light.name)
+        lightIndex.remove(light.name)
         self.save()
 
     def updateLight(self, light):
@@ -330,14 +1208,17 @@ class Config():
     def getRooms(self):
         cRooms = {}
         for roomJson in self.config["rooms"]:
-            cRooms[roomJson["name"]] = Room(roomJson["name"], roomJson["lights"], roomJson["scenes"])
+            cRooms[roomJson["name"]] = Room(roomJson["name"], roomJson["lights"], roomJson["scenes"],
+                                            roomJson.get("group"))
+            cRooms[roomJson["name"]].updatePowerState()
         return cRooms
 
     def addRoom(self, room):
         roomJson = {
             "name": room.name,
             "lights": room.lights,
-            "scenes": room.scenes
+            "scenes": room.scenes,
+            "group": room.group
         }
         self.config["rooms"].append(roomJson)
         self.save()
@@ -347,14 +1228,15 @@ class Config():
             if self.config["rooms"][i]["name"] == room.name:
                 del self.config["rooms"][i]
                 break
-        del rooms[room.name]
+        state.remove("rooms", room.name)
         self.save()
 
     def updateRoom(self, room):
         roomJson = {
             "name": room.name,
             "lights": room.lights,
-            "scenes": room.scenes
+            "scenes": room.scenes,
+            "group": room.group
         }
         for i in range(len(self.config["rooms"])):
             if self.config["rooms"][i]["name"] == room.name:
@@ -403,7 +1285,7 @@ class Config():
             if self.config["scenes"][i]["name"] == scene.name:
                 del self.config["scenes"][i]
                 break
-        del scenes[scene.name]
+        state.remove("scenes", scene.name)
         self.save()
 
     def updateScene(self, scene):
@@ -429,68 +1311,1043 @@ class Config():
                 break
         self.save()
 
-def handleRequest(jsonData, handler, ISUDP=False):
-    packetType = jsonData["id"]
-    if packetType == "infoRequestPacket":
-        if jsonData["data"]["request"] == "room":
-            jsonReturn = rooms[jsonData["data"]["name"]].getInfoPacket()
-        elif jsonData["data"]["request"] == "light":
-            jsonReturn = lights[jsonData["data"]["name"]].getInfoPacket()
-        elif jsonData["data"]["request"] == "allRooms":
-            roomInfoPackets = []
-            for name in rooms:
-                roomInfoPackets.append(rooms[name].getInfoPacket())
-            jsonReturn = {
-                "id": "allRoomsPacket",
-                "data": {
-                    "rooms": roomInfoPackets,
-                    "id": jsonData["data"]["id"]
-                }
-            }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
-        elif jsonData["data"]["request"] == "allLights":
-            lightInfoPackets = []
-            for name in lights:
-                lightInfoPackets.append(lights[name].getInfoPacket())
-            jsonReturn = {
-                "id": "allLightsPacket",
-                "data": {
-                    "lights": lightInfoPackets,
-                    "id": jsonData["data"]["id"]
-                }
-            }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
-        elif jsonData["data"]["request"] == "lightsOfRoom":
-            lightInfoPackets = []
-            for name in rooms[jsonData["data"]["name"]].lights:
-                lightInfoPackets.append(lights[name].getInfoPacket())
-            jsonReturn = {
-                "id": "lightsOfRoomPacket",
-                "data": {
-                    "name": jsonData["data"]["name"],
-                    "lights": lightInfoPackets,
-                    "id": jsonData["data"]["id"]
-                }
-            }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
+    # -- SCHEDULE functions
+    def getSchedules(self):
+        cSchedules = {}
+        for scheduleJson in self.config["schedules"]:
+            cSchedules[scheduleJson["name"]] = Schedule(scheduleJson["name"], scheduleJson["time"],
+                                                        int(scheduleJson.get("offset", 0)),
+                                                        scheduleJson.get("days", []), scheduleJson["action"])
+        return cSchedules
+
+    def addSchedule(self, schedule):
+        scheduleJson = {
+            "name": schedule.name,
+            "time": schedule.at,
+            "offset": schedule.offset,
+            "days": schedule.days,
+            "action": schedule.action
+        }
+        self.config["schedules"].append(scheduleJson)
+        self.save()
+
+    def removeSchedule(self, schedule):
+        for i in range(len(self.config["schedules"])):
+            if self.config["schedules"][i]["name"] == schedule.name:
+                del self.config["schedules"][i]
+                break
+        state.remove("schedules", schedule.name)
+        self.save()
+
+class LazyDict(dict):
+    # knows all names from the start, builds the objects on first access
+    def __init__(self, names, loader, loaded=None, lock=None):
+        super().__init__(dict.fromkeys(names))
+        self.loader = loader
+        self.loaded = {} if loaded is None else loaded  # shared between copies, one object per name
+        self.lock = threading.Lock() if lock is None else lock
+
+    def __getitem__(self, name):
+        value = dict.__getitem__(self, name)
+        if value is None:
+            with self.lock:
+                value = self.loaded.get(name)
+                if value is None:
+                    value = self.loader(name)
+                    self.loaded[name] = value
+        return value
+
+    def copy(self):
+        cCopy = LazyDict([], self.loader, self.loaded, self.lock)
+        dict.update(cCopy, self)
+        return cCopy
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+
+class SQLiteConfig(Config):
+    # same interface as Config, but every change only touches its own rows instead of rewriting the whole file
+    def __init__(self, path, jsonPath=None):
+        self.jsonPath = jsonPath
+        self.lock = threading.RLock()
+        self.db = None
+        super().__init__(path)
+
+    # -- CONFIG functions
+    @contextlib.contextmanager
+    def transaction(self):
+        # the config lock and a sqlite transaction, traced as one persistence step
+        with span("config.sqlite"), self.lock, self.db:
+            yield
+
+    def createDefault(self):
+        with self.transaction():
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS server (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS lights (name TEXT PRIMARY KEY, ledCount INTEGER NOT NULL,
+                    modes TEXT NOT NULL, ip TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS rooms (name TEXT PRIMARY KEY, grp TEXT);
+                CREATE TABLE IF NOT EXISTS room_lights (room TEXT NOT NULL, light TEXT NOT NULL,
+                    PRIMARY KEY (room, light));
+                CREATE INDEX IF NOT EXISTS room_lights_light ON room_lights (light);
+                CREATE TABLE IF NOT EXISTS scenes (name TEXT PRIMARY KEY, room TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS scenes_room ON scenes (room);
+                CREATE TABLE IF NOT EXISTS scene_light_states (scene TEXT NOT NULL, light TEXT NOT NULL,
+                    r INTEGER NOT NULL, g INTEGER NOT NULL, b INTEGER NOT NULL, mode TEXT NOT NULL,
+                    power INTEGER NOT NULL, brightness INTEGER NOT NULL, PRIMARY KEY (scene, light));
+                CREATE TABLE IF NOT EXISTS schedules (name TEXT PRIMARY KEY, data TEXT NOT NULL);
+            """)
+            if "grp" not in [row[1] for row in self.db.execute("PRAGMA table_info(rooms)")]:
+                self.db.execute("ALTER TABLE rooms ADD COLUMN grp TEXT")
+        if self.db.execute("SELECT COUNT(*) FROM server").fetchone()[0] == 0:
+            if self.jsonPath is not None and os.path.isfile(self.jsonPath):
+                self.importJson(self.jsonPath)
+            else:
+                self.importData(self.getDefault())
+
+    def load(self):
+        import sqlite3
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.createDefault()
+        server = {}
+        for key, value in self.db.execute("SELECT key, value FROM server"):
+            server[key] = json.loads(value)
+        self.config = {"server": server}
+        self.configLoaded = True
+        logging.info('CONFIG: Loaded')
+
+    def save(self):
+        with self.transaction():
+            for key in self.config["server"]:
+                self.db.execute("INSERT OR REPLACE INTO server VALUES (?, ?)",
+                                (key, json.dumps(self.config["server"][key])))
+        logging.info('CONFIG: Saved')
+
+    def importJson(self, path):
+        with open(path, "r") as file:
+            data = json.load(file)
+        self.importData(data)
+        logging.info('CONFIG: Migrated ' + path)
+
+    def importData(self, data):
+        with self.transaction():
+            for key in data["server"]:
+                self.db.execute("INSERT OR REPLACE INTO server VALUES (?, ?)", (key, json.dumps(data["server"][key])))
+            for lightJson in data["lights"]:
+                self.db.execute("INSERT OR REPLACE INTO lights VALUES (?, ?, ?, ?)",
+                                (lightJson["name"], int(lightJson["ledCount"]), json.dumps(lightJson["modes"]),
+                                 lightJson["ip"]))
+                for room in lightJson["rooms"]:
+                    self.db.execute("INSERT OR IGNORE INTO room_lights VALUES (?, ?)", (room, lightJson["name"]))
+            for roomJson in data["rooms"]:
+                self.db.execute("INSERT OR IGNORE INTO rooms VALUES (?, ?)", (roomJson["name"], roomJson.get("group")))
+                for light in roomJson["lights"]:
+                    self.db.execute("INSERT OR IGNORE INTO room_lights VALUES (?, ?)", (roomJson["name"], light))
+            for sceneJson in data["scenes"]:
+                self.db.execute("INSERT OR REPLACE INTO scenes VALUES (?, ?)", (sceneJson["name"], sceneJson["room"]))
+                for lsJson in sceneJson["lightStates"]:
+                    self.db.execute("INSERT OR REPLACE INTO scene_light_states VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (sceneJson["name"], lsJson["name"], int(lsJson["color"][0]),
+                                     int(lsJson["color"][1]), int(lsJson["color"][2]), str(lsJson["mode"]),
+                                     int(json.loads(str(lsJson["power"]).lower())), int(lsJson["brightness"])))
+            for scheduleJson in data.get("schedules", []):
+                self.db.execute("INSERT OR REPLACE INTO schedules VALUES (?, ?)",
+                                (scheduleJson["name"], json.dumps(scheduleJson)))
+
+    def replaceData(self, data):
+        with self.transaction():
+            for table in ("server", "lights", "rooms", "room_lights", "scenes", "scene_light_states", "schedules"):
+                self.db.execute("DELETE FROM " + table)
+        self.importData(data)
+        self.config = {"server": dict(data["server"])}
+
+    def getData(self):
+        data = {
+            "server": self.config["server"],
+            "rooms": [],
+            "lights": [],
+            "scenes": [],
+            "schedules": []
+        }
+        with self.lock:
+            for name, ledCount, modes, ip in self.db.execute("SELECT name, ledCount, modes, ip FROM lights"):
+                data["lights"].append({
+                    "name": name,
+                    "rooms": self.getRoomsOfLight(name),
+                    "ledCount": ledCount,
+                    "modes": json.loads(modes),
+                    "ip": ip
+                })
+            for name, group in self.db.execute("SELECT name, grp FROM rooms").fetchall():
+                data["rooms"].append({
+                    "name": name,
+                    "lights": self.getLightsOfRoom(name),
+                    "scenes": self.getScenesOfRoom(name),
+                    "group": group
+                })
+            for name, room in self.db.execute("SELECT name, room FROM scenes").fetchall():
+                lightStateJsons = []
+                for light, r, g, b, mode, power, brightness in self.getLightStatesOfScene(name):
+                    lightStateJsons.append({
+                        "name": light,
+                        "color": [r, g, b],
+                        "mode": mode,
+                        "power": bool(power),
+                        "brightness": brightness
+                    })
+                data["scenes"].append({
+                    "name": name,
+                    "room": room,
+                    "lightStates": lightStateJsons
+                })
+            for (scheduleJson,) in self.db.execute("SELECT data FROM schedules"):
+                data["schedules"].append(json.loads(scheduleJson))
+        return data
+
+    def getRoomsOfLight(self, name):
+        return [row[0] for row in self.db.execute("SELECT room FROM room_lights WHERE light = ? ORDER BY rowid",
+                                                  (name,))]
+
+    def getLightsOfRoom(self, name):
+        return [row[0] for row in self.db.execute("SELECT light FROM room_lights WHERE room = ? ORDER BY rowid",
+                                                  (name,))]
+
+    def getScenesOfRoom(self, name):
+        return [row[0] for row in self.db.execute("SELECT name FROM scenes WHERE room = ? ORDER BY rowid", (name,))]
+
+    def getLightStatesOfScene(self, name):
+        return self.db.execute("SELECT light, r, g, b, mode, power, brightness FROM scene_light_states "
+                               "WHERE scene = ? ORDER BY rowid", (name,)).fetchall()
+
+    # -- LIGHT functions
+    def getLights(self):
+        cLights = {}
+        with self.lock:
+            for name, ledCount, modes, ip in self.db.execute("SELECT name, ledCount, modes, ip FROM lights").fetchall():
+                cLights[name] = Light(name, self.getRoomsOfLight(name), ledCount, LedColor(0, 0, 0), 0, False, 0,
+                                      json.loads(modes), ip)
+        return cLights
+
+    def addLight(self, light):
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO lights VALUES (?, ?, ?, ?)",
+                            (light.name, int(light.ledCount), json.dumps(light.modes), light.ip))
+            for room in light.rooms:
+                self.db.execute("INSERT OR IGNORE INTO room_lights VALUES (?, ?)", (room, light.name))
+
+    def removeLight(self, light):
+        with self.transaction():
+            self.db.execute("DELETE FROM lights WHERE name = ?", (light.name,))
+            self.db.execute("DELETE FROM room_lights WHERE light = ?", (light.name,))
+        state.remove("lights", light.name)
+        lightIndex.remove(light.name)
+
+    def updateLight(self, light):
+        with self.transaction():
+            self.db.execute("UPDATE lights SET ledCount = ?, modes = ?, ip = ? WHERE name = ?",
+                            (int(light.ledCount), json.dumps(light.modes), light.ip, light.name))
+            self.db.execute("DELETE FROM room_lights WHERE light = ? AND room NOT IN (%s)" % ",".join(
+                "?" * len(light.rooms)), [light.name] + list(light.rooms))
+            for room in light.rooms:
+                self.db.execute("INSERT OR IGNORE INTO room_lights VALUES (?, ?)", (room, light.name))
+
+    # -- ROOM functions
+    def getRooms(self):
+        with self.lock:
+            names = [row[0] for row in self.db.execute("SELECT name FROM rooms ORDER BY rowid")]
+        return LazyDict(names, self.loadRoom)
+
+    def loadRoom(self, name):
+        with self.lock:
+            group = self.db.execute("SELECT grp FROM rooms WHERE name = ?", (name,)).fetchone()[0]
+            room = Room(name, self.getLightsOfRoom(name), self.getScenesOfRoom(name), group)
+        room.updatePowerState()
+        return room
+
+    def addRoom(self, room):
+        with self.transaction():
+            self.db.execute("INSERT OR IGNORE INTO rooms VALUES (?, ?)", (room.name, room.group))
+            for light in room.lights:
+                self.db.execute("INSERT OR IGNORE INTO room_lights VALUES (?, ?)", (room.name, light))
+
+    def removeRoom(self, room):
+        with self.transaction():
+            self.db.execute("DELETE FROM rooms WHERE name = ?", (room.name,))
+            self.db.execute("DELETE FROM room_lights WHERE room = ?", (room.name,))
+        state.remove("rooms", room.name)
+
+    def updateRoom(self, room):
+        # the scenes of a room are stored with the scene itself
+        with self.transaction():
+            self.db.execute("UPDATE rooms SET grp = ? WHERE name = ?", (room.group, room.name))
+            self.db.execute("DELETE FROM room_lights WHERE room = ? AND light NOT IN (%s)" % ",".join(
+                "?" * len(room.lights)), [room.name] + list(room.lights))
+            for light in room.lights:
+                self.db.execute("INSERT OR IGNORE INTO room_lights VALUES (?, ?)", (room.name, light))
+
+    # -- SCENE functions
+    def getScenes(self):
+        with self.lock:
+            names = [row[0] for row in self.db.execute("SELECT name FROM scenes ORDER BY rowid")]
+        return LazyDict(names, self.loadScene)
+
+    def loadScene(self, name):
+        with self.lock:
+            room = self.db.execute("SELECT room FROM scenes WHERE name = ?", (name,)).fetchone()[0]
+            ls = {}
+            for light, r, g, b, mode, power, brightness in self.getLightStatesOfScene(name):
+                ls[light] = {"color": LedColor(r, g, b), "mode": mode, "power": bool(power), "brightness": brightness}
+        return Scene(name, room, ls)
+
+    def writeLightStates(self, scene):
+        self.db.execute("DELETE FROM scene_light_states WHERE scene = ?", (scene.name,))
+        for lightState in scene.lightStates:
+            ls = scene.lightStates[lightState]
+            self.db.execute("INSERT INTO scene_light_states VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (scene.name, lightState, int(ls["color"].r), int(ls["color"].g), int(ls["color"].b),
+                             str(ls["mode"]), int(bool(ls["power"])), int(ls["brightness"])))
+
+    def addScene(self, scene):
+        if DEBUG:
+            print("CONFIG: adding Scene: (" + str(scene.name) + ") " + scene.room + " - " + str(
+                len(scene.lightStates)) + " lights")
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO scenes VALUES (?, ?)", (scene.name, scene.room))
+            self.writeLightStates(scene)
+
+    def removeScene(self, scene):
+        with self.transaction():
+            self.db.execute("DELETE FROM scenes WHERE name = ?", (scene.name,))
+            self.db.execute("DELETE FROM scene_light_states WHERE scene = ?", (scene.name,))
+        state.remove("scenes", scene.name)
+
+    def updateScene(self, scene):
+        with self.transaction():
+            self.db.execute("UPDATE scenes SET room = ? WHERE name = ?", (scene.room, scene.name))
+            self.writeLightStates(scene)
+
+    # -- SCHEDULE functions
+    def getSchedules(self):
+        cSchedules = {}
+        with self.lock:
+            for (scheduleJson,) in self.db.execute("SELECT data FROM schedules ORDER BY rowid").fetchall():
+                scheduleJson = json.loads(scheduleJson)
+                cSchedules[scheduleJson["name"]] = Schedule(scheduleJson["name"], scheduleJson["time"],
+                                                            int(scheduleJson.get("offset", 0)),
+                                                            scheduleJson.get("days", []), scheduleJson["action"])
+        return cSchedules
+
+    def addSchedule(self, schedule):
+        scheduleJson = {
+            "name": schedule.name,
+            "time": schedule.at,
+            "offset": schedule.offset,
+            "days": schedule.days,
+            "action": schedule.action
+        }
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO schedules VALUES (?, ?)", (schedule.name, json.dumps(scheduleJson)))
+
+    def removeSchedule(self, schedule):
+        with self.transaction():
+            self.db.execute("DELETE FROM schedules WHERE name = ?", (schedule.name,))
+        state.remove("schedules", schedule.name)
+
+def openLog(path):
+    # opens an append-only log, a torn last line of a crash gets terminated so the next record stays readable
+    file = open(path, "a")
+    if file.tell() > 0:
+        with open(path, "rb") as log:
+            log.seek(-1, os.SEEK_END)
+            if log.read(1) != b"\n":
+                file.write("\n")
+    return file
+
+def lightRecord(light):
+    # runtime state of a light as it is journaled and replicated
+    return [light.name, int(bool(light.power)), light.brightness, light.color.r, light.color.g, light.color.b,
+            light.mode, light.lastSeen]
+
+def applyLightRecord(cLights, record):
+    l = cLights.get(record[0])
+    if l is None:
+        return False
+    _, l.power, l.brightness, r, g, b, l.mode, l.lastSeen = record
+    l.power = bool(l.power)
+    l.color = LedColor(r, g, b)
+    return True
+
+class LightOutbox():
+    # keys (power, brightness, mode, color) a light missed while it was unreachable. The desired values are the
+    # ones of the Light itself, so only the newest value of every key is sent once the light registers again
+    KEYS = ("power", "brightness", "mode", "color")
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = {}  # light name -> set of keys
+        self.file = None
+        self.records = 0
+
+    @staticmethod
+    def getKeys(packetId, data):
+        if packetId == "applyScenePacket":
+            return LightOutbox.KEYS
+        if data.get("key") in LightOutbox.KEYS:
+            return (data["key"],)
+        return ()
+
+    def load(self):
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as file:
+                for line in file:
+                    try:
+                        name, keys = json.loads(line)
+                    except ValueError:  # torn last line
+                        continue
+                    if keys:
+                        self.pending[name] = set(keys)
+                    else:
+                        self.pending.pop(name, None)
+                    self.records = self.records + 1
+        with self.lock:
+            self.compact()
+        return len(self.pending)
+
+    def get(self, name):
+        return self.pending.get(name, ())
+
+    def defer(self, light, keys):
+        if not keys:
+            return
+        with self.lock:
+            pending = self.pending.setdefault(light.name, set())
+            if pending.issuperset(keys):
+                return
+            pending.update(keys)
+            self.write(light.name, pending)
+
+    def delivered(self, light, keys):
+        if light.name not in self.pending:
+            return
+        with self.lock:
+            pending = self.pending.get(light.name)
+            if pending is None or pending.isdisjoint(keys):
+                return
+            pending.difference_update(keys)
+            if not pending:
+                del self.pending[light.name]
+            self.write(light.name, pending)
+
+    def discard(self, name):
+        with self.lock:
+            if self.pending.pop(name, None) is not None:
+                self.write(name, ())
+
+    def write(self, name, keys):
+        # called with the lock held, every record replaces the keys of its light
+        if self.file is None:
+            self.file = openLog(self.path)
+        self.file.write(json.dumps([name, sorted(keys)], separators=(",", ":")) + "\n")
+        self.file.flush()
+        self.records = self.records + 1
+        if self.records > 2 * len(self.pending) + 64:
+            self.compact()
+
+    def compact(self):
+        # called with the lock held
+        if self.records <= len(self.pending):
+            return
+        with open(self.path + ".tmp", "w") as file:
+            for name in self.pending:
+                file.write(json.dumps([name, sorted(self.pending[name])], separators=(",", ":")) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        os.replace(self.path + ".tmp", self.path)
+        self.records = len(self.pending)
+
+def flushOutbox(lightName):
+    # runs on the scheduler thread, the put to the light gets its own thread so the other timers don't wait
+    if state.lights.get(lightName) is None or not outbox.get(lightName):
+        return
+    t = threading.Thread(target=runOutboxFlush, args=(currentSite(), lightName))
+    t.daemon = True
+    t.start()
+
+def runOutboxFlush(site, lightName):
+    # one applyScene with every value the light missed, however many changes it were
+    with activeSite(site):
+        l = state.lights.get(lightName)
+        if l is None or not outbox.get(lightName):
+            return
+        if DEBUG:
+            print("OUTBOX: sending " + ", ".join(sorted(outbox.get(lightName))) + " to " + lightName)
+        try:
+            putLight(l, "applyScene", l.getStatePacket())
+        except Exception as e:
+            if DEBUG:
+                print("HTTP: couldn't reach " + lightName)
+                print(e)
+
+class StateJournal():
+    # append-only log of the runtime state of the lights, so a restart doesn't show every light as black/off
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.records = 0
+
+    def replay(self, cLights):
+        states = {}
+        if os.path.isfile(self.path):
+            with open(self.path, "r") as file:
+                for line in file:
+                    try:
+                        state = json.loads(line)
+                    except ValueError:  # torn last line of a crash, everything before it is fine
+                        continue
+                    states[state[0]] = state
+                    self.records = self.records + 1
+        for name in states:
+            applyLightRecord(cLights, states[name])
+        logging.info('JOURNAL: Replayed ' + str(len(states)) + ' light states')
+        return len(states)
+
+    def record(self, light):
+        line = json.dumps(lightRecord(light), separators=(",", ":")) + "\n"
+        with span("journal"), self.lock:
+            if self.file is None:
+                self.file = openLog(self.path)
+            self.file.write(line)
+            self.file.flush()
+            self.records = self.records + 1
+
+    def compact(self, cLights, force=False):
+        with self.lock:
+            if self.records <= len(cLights) and not force:
+                return
+            with open(self.path + ".tmp", "w") as file:
+                for name in cLights:
+                    file.write(json.dumps(lightRecord(cLights[name]), separators=(",", ":")) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            os.replace(self.path + ".tmp", self.path)
+            self.records = len(cLights)
+        logging.info('JOURNAL: Compacted')
+
+    def compactPeriodically(self):
+        try:
+            self.compact(state.lights)
+        finally:
+            scheduler.callLater(JOURNAL_COMPACT_INTERVAL, self.compactPeriodically)
+
+class LightHistory():
+    # the state changes of one light in preallocated arrays, every light takes the same memory. Once they are
+    # full, the older half is summed up in the history file
+    def __init__(self, name, slot, archived, size=HISTORY_SIZE):
+        self.name = name
+        self.slot = slot  # its part of the history file
+        self.archived = archived  # the history file holds the time before, the arrays the time after
+        self.times = array('d', [0.0]) * size
+        self.power = array('B', [0]) * size
+        self.brightness = array('H', [0]) * size
+        self.color = array('I', [0]) * size
+        self.count = 0
+
+
+class StateHistory():
+    # how long the lights of a site were on and how bright. Recent changes are kept per light in memory, older
+    # ones are summed up in buckets of 15 minutes in a memory mapped file (next to the state journal) that has a
+    # fixed part for every light. Queries are computed with numpy if it is installed. The parts of removed lights
+    # are reused for new ones, so the file only grows with the number of lights at the same time
+    def __init__(self, path):
+        self.path = path
+        self.indexPath = path + ".json"
+        self.lock = threading.Lock()
+        self.lights = {}  # light name -> LightHistory
+        self.slots = {}  # light name -> [slot, archived] as saved in the index
+        self.free = []  # slots of removed lights
+        self.file = None
+        self.map = None
+
+    def load(self):
+        if os.path.isfile(self.indexPath):
+            with open(self.indexPath, "r") as file:
+                index = json.load(file)
+            self.slots = index["slots"]
+            self.free = index.get("free", [])
+        self.file = open(self.path, "a+b")
+        self.resize()
+
+    def resize(self):
+        size = max(len(self.slots) + len(self.free), 1) * HISTORY_BUCKETS * 12
+        if self.map is not None:
+            self.map.close()
+        if os.fstat(self.file.fileno()).st_size < size:
+            self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def saveIndex(self):
+        with open(self.indexPath + ".tmp", "w") as file:
+            json.dump({"slots": self.slots, "free": self.free}, file)
+        os.replace(self.indexPath + ".tmp", self.indexPath)
+
+    @contextlib.contextmanager
+    def columns(self, slot):
+        # bucket numbers, seconds on and brightness * seconds on of one light, straight on the mapped file
+        offset = slot * HISTORY_BUCKETS * 12
+        size = HISTORY_BUCKETS * 4
+        with memoryview(self.map) as view, view[offset:offset + size].cast('I') as buckets, \
+                view[offset + size:offset + 2 * size].cast('f') as onTimes, \
+                view[offset + 2 * size:offset + 3 * size].cast('f') as brightness:
+            yield buckets, onTimes, brightness
+
+    def get(self, name):
+        # called with the lock held
+        h = self.lights.get(name)
+        if h is None:
+            if name not in self.slots:
+                if self.free:
+                    slot = self.free.pop()
+                    self.clear(slot)
+                else:
+                    slot = len(self.slots)
+                self.slots[name] = [slot, time.time()]
+                self.resize()
+                self.saveIndex()
+            h = LightHistory(name, *self.slots[name])
+            self.lights[name] = h
+        return h
+
+    def clear(self, slot):
+        size = HISTORY_BUCKETS * 12
+        self.map[slot * size:(slot + 1) * size] = bytes(size)
+
+    def remove(self, names):
+        # frees the slots of removed lights for the next new ones
+        with self.lock:
+            for name in names:
+                self.lights.pop(name, None)
+                slot = self.slots.pop(name, None)
+                if slot is not None:
+                    self.free.append(slot[0])
+            self.saveIndex()
+
+    def record(self, light, now=None):
+        now = time.time() if now is None else now
+        color = (light.color.r << 16) | (light.color.g << 8) | light.color.b
+        power = int(bool(light.power))
+        brightness = min(max(int(light.brightness), 0), 65535)
+        with self.lock:
+            h = self.get(light.name)
+            i = h.count - 1
+            if i >= 0 and h.power[i] == power and h.brightness[i] == brightness and h.color[i] == color:
+                return
+            now = max(now, h.times[i] if i >= 0 else h.archived)  # the clock was set back
+            if h.count == len(h.times):
+                self.archive(h, max(h.times[h.count // 2], h.times[1] + 1e-3))
+            i = h.count
+            h.times[i] = now
+            h.power[i] = power
+            h.brightness[i] = brightness
+            h.color[i] = color
+            h.count = i + 1
+
+    def archive(self, h, cutoff):
+        # sums up the changes of one light before cutoff, the last of them stays as the state at cutoff
+        n = bisect.bisect_left(h.times, cutoff, 0, h.count)
+        if n == 0:
+            return
+        with self.columns(h.slot) as (buckets, onTimes, brightness):
+            for i in range(n):
+                if not h.power[i]:
+                    continue
+                start = max(h.times[i], h.archived)
+                end = min(h.times[i + 1], cutoff) if i + 1 < h.count else cutoff
+                while start < end:
+                    bucket = int(start // HISTORY_BUCKET)
+                    split = min(end, (bucket + 1) * HISTORY_BUCKET)
+                    j = bucket % HISTORY_BUCKETS
+                    if buckets[j] != bucket:
+                        buckets[j] = bucket
+                        onTimes[j] = 0.0
+                        brightness[j] = 0.0
+                    onTimes[j] = onTimes[j] + (split - start)
+                    brightness[j] = brightness[j] + (split - start) * h.brightness[i]
+                    start = split
+        keep = h.count - n + 1
+        for column in (h.times, h.power, h.brightness, h.color):
+            column[0:keep] = column[n - 1:h.count]
+        h.times[0] = cutoff
+        h.count = keep
+        h.archived = cutoff
+        self.slots[h.name][1] = cutoff
+
+    def archiveAll(self, cutoff):
+        with self.lock:
+            for name in self.lights:
+                self.archive(self.lights[name], cutoff)
+            self.map.flush()
+            self.saveIndex()
+
+    def archivePeriodically(self):
+        try:
+            self.archiveAll(time.time() - HISTORY_RECENT)
+        finally:
+            scheduler.callLater(HISTORY_ARCHIVE_INTERVAL, self.archivePeriodically)
+
+    def query(self, names, start, end):
+        # seconds on and brightness * seconds on of every light between start and end, the history file only
+        # knows whole buckets of 15 minutes
+        np = getNumpy()
+        now = time.time()
+        results = {}
+        with self.lock:
+            for name in names:
+                onTime = 0.0
+                brightness = 0.0
+                if name in self.slots:
+                    h = self.get(name)
+                    if start < h.archived:
+                        first = int(start // HISTORY_BUCKET)
+                        last = int((min(end, h.archived) - 1e-6) // HISTORY_BUCKET)
+                        with self.columns(h.slot) as (buckets, onTimes, brightnessTimes):
+                            if np is not None:
+                                b = np.frombuffer(buckets, dtype=np.uint32)
+                                mask = (b >= first) & (b <= last)
+                                onTime = onTime + float(np.frombuffer(onTimes, dtype=np.float32)[mask].sum())
+                                brightness = brightness + float(
+                                    np.frombuffer(brightnessTimes, dtype=np.float32)[mask].sum())
+                                del b, mask
+                            else:
+                                for j in range(HISTORY_BUCKETS):
+                                    if first <= buckets[j] <= last:
+                                        onTime = onTime + onTimes[j]
+                                        brightness = brightness + brightnessTimes[j]
+                    if h.count and end > h.archived:
+                        recentOn, recentBrightness = self.sumRecent(np, h, max(start, h.archived), min(end, now), now)
+                        onTime = onTime + recentOn
+                        brightness = brightness + recentBrightness
+                results[name] = (onTime, brightness)
+        return results
+
+    @staticmethod
+    def sumRecent(np, h, start, end, now):
+        n = h.count
+        if np is not None:
+            times = np.frombuffer(h.times, dtype=np.float64, count=n)
+            ends = np.empty(n)
+            ends[:-1] = times[1:]
+            ends[-1] = now
+            durations = np.clip(ends, start, end) - np.clip(times, start, end)
+            durations = durations * np.frombuffer(h.power, dtype=np.uint8, count=n)
+            return float(durations.sum()), float(durations @ np.frombuffer(h.brightness, dtype=np.uint16, count=n))
+        onTime = 0.0
+        brightness = 0.0
+        for i in range(n):
+            if h.power[i]:
+                duration = min(max(h.times[i + 1] if i + 1 < n else now, start), end) - min(max(h.times[i], start), end)
+                onTime = onTime + duration
+                brightness = brightness + duration * h.brightness[i]
+        return onTime, brightness
+
+
+def getHistory(snapshot, start, end, lightName=None, roomName=None):
+    if lightName is not None:
+        names = [lightName]
+        rooms = []
+    elif roomName is not None:
+        names = list(snapshot.rooms[roomName].lights)
+        rooms = [roomName]
+    else:
+        names = list(snapshot.lights)
+        rooms = list(snapshot.rooms)
+    sums = history.query(names, start, end)
+    lights = dict((name, {"onTime": sums[name][0],
+                          "averageBrightness": sums[name][1] / sums[name][0] if sums[name][0] else None})
+                  for name in names)
+    roomsData = {}
+    for name in rooms:
+        onTime = sum(sums[lightName][0] for lightName in snapshot.rooms[name].lights if lightName in sums)
+        brightness = sum(sums[lightName][1] for lightName in snapshot.rooms[name].lights if lightName in sums)
+        roomsData[name] = {"onTime": onTime, "averageBrightness": brightness / onTime if onTime else None}
+    return {"from": start, "to": end, "lights": lights, "rooms": roomsData}
+
+
+class LightIndex():
+    # power and health of every light, kept up to date on each change so info requests can filter
+    # on them without looking at every light
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.power = {True: set(), False: set()}
+        self.health = {"online": set(), "unknown": set(), "unreachable": set()}
+        self.sortedNames = None
+
+    def update(self, light):
+        entry = (bool(light.power), light.getHealth())
+        with self.lock:
+            old = self.entries.get(light.name)
+            if old == entry:
+                return
+            if old is None:
+                self.sortedNames = None
+            else:
+                self.power[old[0]].discard(light.name)
+                self.health[old[1]].discard(light.name)
+            self.entries[light.name] = entry
+            self.power[entry[0]].add(light.name)
+            self.health[entry[1]].add(light.name)
+
+    def remove(self, name):
+        with self.lock:
+            old = self.entries.pop(name, None)
+            if old is not None:
+                self.power[old[0]].discard(name)
+                self.health[old[1]].discard(name)
+                self.sortedNames = None
+
+    def select(self, snapshot, filters, roomName=None):
+        sets = []
+        if roomName is not None:
+            sets.append(set(snapshot.rooms[roomName].lights))
+        if "room" in filters:
+            sets.append(set(snapshot.rooms[filters["room"]].lights))
+        with self.lock:
+            if "power" in filters:
+                sets.append(self.power[str(filters["power"]).lower() == "true"])
+            if "health" in filters:
+                sets.append(self.health.get(filters["health"], set()))
+            if not sets:
+                if self.sortedNames is None:
+                    self.sortedNames = sorted(self.entries)
+                if len(self.sortedNames) == len(snapshot.lights):
+                    return self.sortedNames
+                return [name for name in self.sortedNames if name in snapshot.lights]
+            sets.sort(key=len)
+            names = set(sets[0]).intersection(*sets[1:])
+        return sorted(name for name in names if name in snapshot.lights)
+
+SCENE_FIELDS = ("name", "room", "lightStates")
+
+def isQuery(data):
+    return "fields" in data or "filter" in data or "limit" in data or "cursor" in data
+
+def getFields(data, known):
+    if "fields" not in data:
+        return None
+    return [field for field in data["fields"] if field in known]
+
+def paginate(names, data):
+    # names are sorted, the cursor is the last name of the previous page
+    start = 0
+    if data.get("cursor") is not None:
+        start = bisect.bisect_right(names, data["cursor"])
+    limit = int(data.get("limit", 0))
+    if limit <= 0 or start + limit >= len(names):
+        return names[start:], None
+    page = names[start:start + limit]
+    return page, page[-1]
+
+class CachedAnswer():
+    def __init__(self):
+        self.done = threading.Event()
+        self.answer = None
+        self.fingerprint = None  # the object the request changed, as it was after the request
+        self.time = time.monotonic()
+
+
+class RequestCache():
+    # apps retry requests they got no answer for, over a bad wifi often several times. The answer of a changing
+    # request is kept under (client, id, request) for a few seconds and a retry gets it without changing, saving
+    # and sending anything again, a retry of a request that still runs waits for its answer. An answer is only
+    # reused while the light, room, scene or schedule the request is about is unchanged, apps that send the same
+    # id for every request can still switch a light on, off and on again. Changes of anything else don't matter
+    PACKETS = ("createRequestPacket", "editRequestPacket", "removeRequestPacket", "changeValueRequestPacket")
+    TARGETS = {"light": "lights", "room": "rooms", "scene": "scenes", "schedule": "schedules",
+               "lightsOfRoom": "rooms", "groupOfRoom": "rooms", "lightStatesOfScene": "scenes"}
+
+    def __init__(self, size=REQUEST_CACHE_SIZE, ttl=REQUEST_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.answers = OrderedDict()  # key -> CachedAnswer, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def getKey(jsonData, client):
+        data = jsonData.get("data") or {}
+        if jsonData["id"] not in RequestCache.PACKETS or data.get("id") is None:
+            return None
+        return (client, jsonData["id"], str(data["id"]), hash(jsonDumps(jsonData)))
+
+    @staticmethod
+    def getFingerprint(data):
+        kind = RequestCache.TARGETS.get(data.get("request"))
+        if kind is None:
+            return None
+        target = getattr(state.snapshot(), kind).get(data.get("name"))
+        return jsonDumps(target.getInfoPacket()) if target is not None else None
+
+    def isStale(self, cached, data, now):
+        return cached.done.is_set() and (cached.answer is None or now - cached.time > self.ttl
+                                         or cached.fingerprint != self.getFingerprint(data))
+
+    def begin(self, key, data):
+        # the cached answer and False for a retry, a new entry and True for the first request
+        now = time.monotonic()
+        with self.lock:
+            while self.answers:
+                oldest = next(iter(self.answers.values()))
+                if not oldest.done.is_set() or now - oldest.time <= self.ttl:
+                    break
+                self.answers.popitem(last=False)
+            cached = self.answers.get(key)
+            if cached is not None and not self.isStale(cached, data, now):
+                self.answers.move_to_end(key)
+                self.hits = self.hits + 1
+                return cached, False
+            self.misses = self.misses + 1
+            cached = CachedAnswer()
+            self.answers[key] = cached
+            self.answers.move_to_end(key)
+            if len(self.answers) > self.size:
+                self.answers.popitem(last=False)
+            return cached, True
+
+    def finish(self, key, cached, data, answer):
+        cached.answer = answer
+        cached.fingerprint = self.getFingerprint(data)
+        cached.time = time.monotonic()
+        cached.done.set()
+        if answer is None:
+            with self.lock:
+                if self.answers.get(key) is cached:
+                    del self.answers[key]
+
+    def getMetrics(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "answers": len(self.answers)}
+
+
+def handleRequest(jsonData, handler, ISUDP=False):
+    # creating, editing and removing only touches the server itself, so these requests are serialized by the
+    # writer lock of the state, value changes wait for the lights and stay outside of it. Returns None for
+    # retries answered from the request cache
+    data = jsonData.get("data") or {}
+    key = RequestCache.getKey(jsonData, handler.client_address[0]) if not ISUDP else None
+    if key is not None:
+        cached, first = requestCache.begin(key, data)
+        if not first:
+            with span("cached", packet=jsonData["id"], id=data.get("id")):
+                if cached.done.wait(REQUEST_CACHE_WAIT) and cached.answer:
+                    sendJson(handler, cached.answer)
+            return None
+    jsonReturn = None
+    try:
+        with span("dispatch", packet=jsonData["id"], request=data.get("request"), id=data.get("id")):
+            if jsonData["id"] in ("createRequestPacket", "editRequestPacket", "removeRequestPacket"):
+                with state.lock, replicatedRequest(jsonData):
+                    jsonReturn = dispatchRequest(jsonData)
+            else:
+                jsonReturn = dispatchRequest(jsonData)
+    finally:
+        if key is not None:
+            requestCache.finish(key, cached, data, jsonReturn)
+    if not ISUDP and jsonReturn:
+        sendJson(handler, jsonReturn)
+    return jsonReturn
+
+def dispatchRequest(jsonData):
+    jsonReturn = None
+    packetType = jsonData["id"]
+    if packetType == "infoRequestPacket":
+        snapshot = state.snapshot()
+        if jsonData["data"]["request"] == "room":
+            jsonReturn = snapshot.rooms[jsonData["data"]["name"]].getInfoPacket()
+        elif jsonData["data"]["request"] == "light":
+            jsonReturn = snapshot.lights[jsonData["data"]["name"]].getInfoPacket()
+        elif jsonData["data"]["request"] == "allRooms":
+            roomInfoPackets = []
+            for name in snapshot.rooms:
+                roomInfoPackets.append(snapshot.rooms[name].getInfoPacket())
+            jsonReturn = {
+                "id": "allRoomsPacket",
+                "data": {
+                    "rooms": roomInfoPackets,
+                    "id": jsonData["data"]["id"]
+                }
+            }
+        elif jsonData["data"]["request"] == "allLights":
+            if isQuery(jsonData["data"]):
+                names, cursor = paginate(lightIndex.select(snapshot, jsonData["data"].get("filter", {})),
+                                         jsonData["data"])
+            else:
+                names, cursor = snapshot.lights, None
+            lightInfoPackets = []
+            for name in names:
+                lightInfoPackets.append(snapshot.lights[name].getInfoPacket(getFields(jsonData["data"], LIGHT_FIELDS)))
+            jsonReturn = {
+                "id": "allLightsPacket",
+                "data": {
+                    "lights": lightInfoPackets,
+                    "id": jsonData["data"]["id"]
+                }
+            }
+            if isQuery(jsonData["data"]):
+                jsonReturn["data"]["cursor"] = cursor
+        elif jsonData["data"]["request"] == "lightsOfRoom":
+            if isQuery(jsonData["data"]):
+                names, cursor = paginate(lightIndex.select(snapshot, jsonData["data"].get("filter", {}),
+                                                           jsonData["data"]["name"]), jsonData["data"])
+            else:
+                names, cursor = snapshot.rooms[jsonData["data"]["name"]].lights, None
+            lightInfoPackets = []
+            for name in names:
+                lightInfoPackets.append(snapshot.lights[name].getInfoPacket(getFields(jsonData["data"], LIGHT_FIELDS)))
+            jsonReturn = {
+                "id": "lightsOfRoomPacket",
+                "data": {
+                    "name": jsonData["data"]["name"],
+                    "lights": lightInfoPackets,
+                    "id": jsonData["data"]["id"]
+                }
+            }
+            if isQuery(jsonData["data"]):
+                jsonReturn["data"]["cursor"] = cursor
         elif jsonData["data"]["request"] == "scene":
-            jsonReturn = scenes[jsonData["data"]["name"]].getInfoPacket()
+            jsonReturn = snapshot.scenes[jsonData["data"]["name"]].getInfoPacket()
         elif jsonData["data"]["request"] == "allScenes":
+            if isQuery(jsonData["data"]):
+                filters = jsonData["data"].get("filter", {})
+                if "room" in filters:
+                    names = sorted(snapshot.rooms[filters["room"]].scenes)
+                else:
+                    names = sorted(snapshot.scenes)
+                names, cursor = paginate(names, jsonData["data"])
+            else:
+                names, cursor = snapshot.scenes, None
             sceneInfoPackets = []
-            for name in scenes:
-                sceneInfoPackets.append(scenes[name].getInfoPacket())
+            for name in names:
+                sceneInfoPackets.append(snapshot.scenes[name].getInfoPacket(getFields(jsonData["data"], SCENE_FIELDS)))
             jsonReturn = {
                 "id": "allScenesPacket",
                 "data": {
@@ -498,15 +2355,12 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
+            if isQuery(jsonData["data"]):
+                jsonReturn["data"]["cursor"] = cursor
         elif jsonData["data"]["request"] == "scenesOfRoom":
             sceneInfoPackets = []
-            for name in rooms[jsonData["data"]["name"]].scenes:
-                sceneInfoPackets.append(scenes[name].getInfoPacket())
+            for name in snapshot.rooms[jsonData["data"]["name"]].scenes:
+                sceneInfoPackets.append(snapshot.scenes[name].getInfoPacket())
             jsonReturn = {
                 "id": "cenesOfRoomPacket",
                 "data": {
@@ -515,18 +2369,30 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
+        elif jsonData["data"]["request"] == "schedule":
+            jsonReturn = snapshot.schedules[jsonData["data"]["name"]].getInfoPacket()
+        elif jsonData["data"]["request"] == "allSchedules":
+            scheduleInfoPackets = []
+            for name in snapshot.schedules:
+                scheduleInfoPackets.append(snapshot.schedules[name].getInfoPacket())
+            jsonReturn = {
+                "id": "allSchedulesPacket",
+                "data": {
+                    "schedules": scheduleInfoPackets,
+                    "id": jsonData["data"]["id"]
+                }
+            }
     elif packetType == "createRequestPacket":
         if jsonData["data"]["request"] == "room":
             jsonReturn = ""
-            if not jsonData["data"]["name"] in rooms:
-                nRoom = Room(jsonData["data"]["name"], [], [])
-                rooms[jsonData["data"]["name"]] = nRoom
+            if not jsonData["data"]["name"] in state.rooms:
+                group = jsonData["data"].get("group")
+                if group is True:
+                    group = allocateGroupAddress()
+                nRoom = Room(jsonData["data"]["name"], [], [], group or None)
+                state.put("rooms", jsonData["data"]["name"], nRoom)
                 config.addRoom(nRoom)
+                events.publish("room", nRoom.getInfoPacket()["data"])
                 if config.config["server"]["mqttauth"] == "True":
                     client.subscribe(nRoom.name)
                 jsonReturn = {
@@ -544,49 +2410,51 @@ def handleRequest(jsonData, handler, ISUDP=False):
                         "id": jsonData["data"]["id"]
                     }
                 }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
         elif jsonData["data"][
             "request"] == "light":  # used as a register and setup function! lights should send an initial packet with the createPacketRequest.light id
-            if not jsonData["data"]["name"] in lights:  # register if unknown
+            if not jsonData["data"]["name"] in state.lights:  # register if unknown
                 nLight = Light(jsonData["data"]["name"], [], int(jsonData["data"]["ledCount"]),
                                LedColor(int(jsonData["data"]["color"][0]), int(jsonData["data"]["color"][1]),
                                         int(jsonData["data"]["color"][2])), str(jsonData["data"]["mode"]),
                                bool(jsonData["data"]["power"]), int(jsonData["data"]["brightness"]),
                                jsonData["data"]["modes"], jsonData["data"]["ip"])
-                lights[jsonData["data"]["name"]] = nLight
+                nLight.lastSeen = time.time()
+                state.put("lights", jsonData["data"]["name"], nLight)
                 config.addLight(nLight)
+                lightChanged(nLight)
                 if config.config["server"]["mqttauth"] == "True":
                     client.subscribe(nLight.name)
             else:  # light already exists, set initial/last known values
-                l = lights[jsonData["data"]["name"]]
-                l.color = LedColor(int(jsonData["data"]["color"][0]), int(jsonData["data"]["color"][1]),
-                                   int(jsonData["data"]["color"][2]))
-                l.mode = str(jsonData["data"]["mode"])
-                l.brightness = int(jsonData["data"]["brightness"])
-                l.power = bool(jsonData["data"]["power"])
+                l = state.lights[jsonData["data"]["name"]]
+                missed = outbox.get(l.name)  # for these the server has newer values than the light
+                if "color" not in missed:
+                    l.color = LedColor(int(jsonData["data"]["color"][0]), int(jsonData["data"]["color"][1]),
+                                       int(jsonData["data"]["color"][2]))
+                if "mode" not in missed:
+                    l.mode = str(jsonData["data"]["mode"])
+                if "brightness" not in missed:
+                    l.brightness = int(jsonData["data"]["brightness"])
+                if "power" not in missed:
+                    l.power = bool(jsonData["data"]["power"])
                 l.modes = jsonData["data"]["modes"]
                 l.ip = jsonData["data"]["ip"]
-                for room in l.rooms:
-                    rooms[room].updatePowerState()
+                l.lastSeen = time.time()
+                l.failures = 0
+                if missed:
+                    scheduler.callLater(OUTBOX_FLUSH_DELAY, flushOutbox, l.name)
+                lightChanged(l)
             jsonReturn = {
                 "id": "successPacket",
                 "data": {
                     "message": "Licht registriert.",  # always return success, no error needed
+                    # multicast groups the light has to join for room commands
+                    "groups": getGroupsOfLight(state.lights[jsonData["data"]["name"]]),
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
 
         elif jsonData["data"]["request"] == "scene":
-            if not jsonData["data"]["name"] in scenes:
+            if not jsonData["data"]["name"] in state.scenes:
                 ls = {}
                 for lsJson in jsonData["data"]["lightStates"]:
                     ls[lsJson["name"]] = {
@@ -594,9 +2462,10 @@ def handleRequest(jsonData, handler, ISUDP=False):
                         "mode": str(lsJson["mode"]), "power": json.loads(str(lsJson["power"]).lower()),
                         "brightness": int(lsJson["brightness"])}
                 nScene = Scene(jsonData["data"]["name"], jsonData["data"]["room"], ls)
-                scenes[nScene.name] = nScene
-                rooms[nScene.room].addScene(nScene.name)
+                state.put("scenes", nScene.name, nScene)
+                state.rooms[nScene.room].addScene(nScene.name)
                 config.addScene(nScene)
+                events.publish("scene", nScene.getInfoPacket()["data"])
             jsonReturn = {
                 "id": "successPacket",
                 "data": {
@@ -604,23 +2473,59 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
+        elif jsonData["data"]["request"] == "schedule":
+            try:
+                nSchedule = Schedule(jsonData["data"]["name"], str(jsonData["data"]["time"]),
+                                     int(jsonData["data"].get("offset", 0)),
+                                     [int(day) for day in jsonData["data"].get("days", [])],
+                                     jsonData["data"]["action"])
+                nSchedule.validate()
+                invalid = None
+            except (ValueError, TypeError) as e:
+                invalid = str(e)
+            if invalid is not None:
+                jsonReturn = {
+                    "id": "errorPacket",
+                    "data": {
+                        "message": "Ungültiger Zeitplan: " + invalid,
+                        "id": jsonData["data"]["id"]
+                    }
+                }
+            elif not jsonData["data"]["name"] in state.schedules:
+                state.put("schedules", nSchedule.name, nSchedule)
+                config.addSchedule(nSchedule)
+                nSchedule.arm()
+                jsonReturn = {
+                    "id": "successPacket",
+                    "data": {
+                        "message": "Zeitplan erstellt.",
+                        "id": jsonData["data"]["id"]
+                    }
+                }
+            else:
+                jsonReturn = {
+                    "id": "errorPacket",
+                    "data": {
+                        "message": "Ein Zeitplan mit diesem Namen existiert bereits.",
+                        "id": jsonData["data"]["id"]
+                    }
+                }
     elif packetType == "editRequestPacket":
         if jsonData["data"]["request"] == "lightsOfRoom":
-            room = rooms[jsonData["data"]["name"]]
-            removeList = [x for x in room.lights if x not in jsonData["data"]["lights"]]
+            room = state.rooms[jsonData["data"]["name"]]
+            wanted = set(jsonData["data"]["lights"])
+            removeList = [x for x in room.lights if x not in wanted]
             for name in removeList:
-                room.removeLight(lights[name])
-                lights[name].removeRoom(room)
+                room.removeLight(state.lights[name])
+                state.lights[name].removeRoom(room)
+            added = []
             for name in jsonData["data"]["lights"]:
-                if not name in room.lights:
-                    room.addLight(lights[name])
-                    lights[name].addRoom(room)
-            room.updatePowerState()
+                if not name in room.lightNames:
+                    room.addLight(state.lights[name])
+                    state.lights[name].addRoom(room)
+                    added.append(name)
+            if room.group is not None:
+                pushGroups(removeList + added)
             jsonReturn = {
                 "id": "successPacket",
                 "data": {
@@ -628,13 +2533,23 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
+        if jsonData["data"]["request"] == "groupOfRoom":
+            room = state.rooms[jsonData["data"]["name"]]
+            group = jsonData["data"]["group"]
+            if group is True:
+                group = room.group or allocateGroupAddress()
+            if (group or None) != room.group:
+                room.setGroup(group or None)
+                pushGroups(room.lights)
+            jsonReturn = {
+                "id": "successPacket",
+                "data": {
+                    "message": "Gruppe des Raums bearbeitet.",
+                    "id": jsonData["data"]["id"]
+                }
+            }
         if jsonData["data"]["request"] == "lightStatesOfScene":
-            scene = scenes[jsonData["data"]["name"]]
+            scene = state.scenes[jsonData["data"]["name"]]
             ls = {}
             for lsJson in jsonData["data"]["lightStates"]:
                 ls[lsJson["name"], {
@@ -643,6 +2558,7 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "brightness": int(lsJson["brightness"])}]
             scene.lightStates = ls
             config.updateScene(scene)
+            events.publish("scene", scene.getInfoPacket()["data"])
             jsonReturn = {
                 "id": "successPacket",
                 "data": {
@@ -650,17 +2566,15 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
     elif packetType == "removeRequestPacket":
         if jsonData["data"]["request"] == "room":
-            room = rooms[jsonData["data"]["name"]]
+            room = state.rooms[jsonData["data"]["name"]]
             for lightName in room.lights:
-                lights[lightName].removeRoom(room)
+                state.lights[lightName].removeRoom(room)
             config.removeRoom(room)
+            if room.group is not None:
+                pushGroups(room.lights)
+            events.publish("removed", {"kind": "room", "name": room.name})
             jsonReturn = {
                 "id": "successPacket",
                 "data": {
@@ -668,16 +2582,16 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
         if jsonData["data"]["request"] == "light":
-            light = lights[jsonData["data"]["name"]]
-            for roomName in light.rooms:
-                rooms[roomName].removeLight(light)
+            light = state.lights[jsonData["data"]["name"]]
+            for roomName in list(light.rooms):
+                state.rooms[roomName].removeLight(light)
+                light.removeRoom(state.rooms[roomName])
             config.removeLight(light)
+            outbox.discard(light.name)
+            history.remove([light.name])
+            frameStream.discard(currentSite(), light.name)
+            events.publish("removed", {"kind": "light", "name": light.name})
             jsonReturn = {
                 "id": "successPacket",
                 "data": {
@@ -685,15 +2599,11 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
         if jsonData["data"]["request"] == "scene":
-            scene = scenes[jsonData["data"]["name"]]
-            rooms[scene.room].removeScene(scene)
+            scene = state.scenes[jsonData["data"]["name"]]
+            state.rooms[scene.room].removeScene(scene)
             config.removeScene(scene)
+            events.publish("removed", {"kind": "scene", "name": scene.name})
             jsonReturn = {
                 "id": "successPacket",
                 "data": {
@@ -701,18 +2611,24 @@ def handleRequest(jsonData, handler, ISUDP=False):
                     "id": jsonData["data"]["id"]
                 }
             }
-            if not ISUDP:
-                handler.send_response(200)
-                handler.send_header('Content-type', 'application/json')
-                handler.end_headers()
-                handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
+        if jsonData["data"]["request"] == "schedule":
+            schedule = state.schedules[jsonData["data"]["name"]]
+            schedule.disarm()
+            config.removeSchedule(schedule)
+            jsonReturn = {
+                "id": "successPacket",
+                "data": {
+                    "message": "Zeitplan gelöscht.",
+                    "id": jsonData["data"]["id"]
+                }
+            }
     elif packetType == "changeValueRequestPacket":
         if jsonData["data"]["request"] == "room":
             if jsonData["data"]["key"] == "power":
                 if jsonData["data"]["value"] == "toggle":
-                    rooms[jsonData["data"]["name"]].togglePower(not rooms[jsonData["data"]["name"]].power)
+                    state.rooms[jsonData["data"]["name"]].togglePower(not state.rooms[jsonData["data"]["name"]].power)
                 else:
-                    rooms[jsonData["data"]["name"]].togglePower(json.loads(jsonData["data"]["value"].lower()))
+                    state.rooms[jsonData["data"]["name"]].togglePower(json.loads(jsonData["data"]["value"].lower()))
                 jsonReturn = {
                     "id": "successPacket",
                     "data": {
@@ -720,13 +2636,8 @@ def handleRequest(jsonData, handler, ISUDP=False):
                         "id": jsonData["data"]["id"]
                     }
                 }
-                if not ISUDP:
-                    handler.send_response(200)
-                    handler.send_header('Content-type', 'application/json')
-                    handler.end_headers()
-                    handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
             elif jsonData["data"]["key"] == "brightness":
-                rooms[jsonData["data"]["name"]].setRoomBrightness(int(jsonData["data"]["value"]))
+                state.rooms[jsonData["data"]["name"]].setRoomBrightness(int(jsonData["data"]["value"]))
                 jsonReturn = {
                     "id": "successPacket",
                     "data": {
@@ -734,27 +2645,21 @@ def handleRequest(jsonData, handler, ISUDP=False):
                         "id": jsonData["data"]["id"]
                     }
                 }
-                if not ISUDP:
-                    handler.send_response(200)
-                    handler.send_header('Content-type', 'application/json')
-                    handler.end_headers()
-                    handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
         elif jsonData["data"]["request"] == "light":
             if jsonData["data"]["key"] == "power":
                 if jsonData["data"]["value"] == "toggle":
-                    lights[jsonData["data"]["name"]].togglePower(not lights[jsonData["data"]["name"]].power)
+                    state.lights[jsonData["data"]["name"]].togglePower(not state.lights[jsonData["data"]["name"]].power)
                 else:
-                    lights[jsonData["data"]["name"]].togglePower(json.loads(jsonData["data"]["value"].lower()))
+                    state.lights[jsonData["data"]["name"]].togglePower(json.loads(jsonData["data"]["value"].lower()))
+                lightChanged(state.lights[jsonData["data"]["name"]])
                 if config.config["server"]["mqttauth"] == "True":
                     client.publish(jsonData["data"]["name"],
-                                   payload=str(lights[jsonData["data"]["name"]].power).lower(), qos=0, retain=False)
-                for room in lights[jsonData["data"]["name"]].rooms:
-                    rooms[room].updatePowerState()
-                response = requests.put("http://" + lights[jsonData["data"]["name"]].ip + ":80/diyledapi/" + str(
-                    hex(get_mac())) + "/updateValue", data=json.dumps(jsonData).encode('utf-8'))
-                response = json.loads(response.content.decode('utf-8'))
+                                   payload=str(state.lights[jsonData["data"]["name"]].power).lower(), qos=0, retain=False)
+                response = putLightValue(state.lights[jsonData["data"]["name"]], jsonData)
                 jsonReturn = ""
-                if response["id"] == "successPacket":
+                if response is None:
+                    jsonReturn = getQueuedPacket(jsonData)
+                elif response["id"] == "successPacket":
                     jsonReturn = {
                         "id": "successPacket",
                         "data": {
@@ -770,18 +2675,14 @@ def handleRequest(jsonData, handler, ISUDP=False):
                             "id": jsonData["data"]["id"]
                         }
                     }
-                if not ISUDP:
-                    handler.send_response(200)
-                    handler.send_header('Content-type', 'application/json')
-                    handler.end_headers()
-                    handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
             if jsonData["data"]["key"] == "brightness":
-                lights[jsonData["data"]["name"]].brightness = int(jsonData["data"]["value"])
-                response = requests.put("http://" + lights[jsonData["data"]["name"]].ip + ":80/diyledapi/" + str(
-                    hex(get_mac())) + "/updateValue", data=json.dumps(jsonData).encode('utf-8'))
-                response = json.loads(response.content.decode('utf-8'))
+                state.lights[jsonData["data"]["name"]].brightness = int(jsonData["data"]["value"])
+                lightChanged(state.lights[jsonData["data"]["name"]])
+                response = putLightValue(state.lights[jsonData["data"]["name"]], jsonData)
                 jsonReturn = ""
-                if response["id"] == "successPacket":
+                if response is None:
+                    jsonReturn = getQueuedPacket(jsonData)
+                elif response["id"] == "successPacket":
                     jsonReturn = {
                         "id": "successPacket",
                         "data": {
@@ -797,18 +2698,14 @@ def handleRequest(jsonData, handler, ISUDP=False):
                             "id": jsonData["data"]["id"]
                         }
                     }
-                if not ISUDP:
-                    handler.send_response(200)
-                    handler.send_header('Content-type', 'application/json')
-                    handler.end_headers()
-                    handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
             if jsonData["data"]["key"] == "mode":
-                lights[jsonData["data"]["name"]].mode = str(jsonData["data"]["value"])
-                response = requests.put("http://" + lights[jsonData["data"]["name"]].ip + ":80/diyledapi/" + str(
-                    hex(get_mac())) + "/updateValue", data=json.dumps(jsonData).encode('utf-8'))
-                response = json.loads(response.content.decode('utf-8'))
+                state.lights[jsonData["data"]["name"]].mode = str(jsonData["data"]["value"])
+                lightChanged(state.lights[jsonData["data"]["name"]])
+                response = putLightValue(state.lights[jsonData["data"]["name"]], jsonData)
                 jsonReturn = ""
-                if response["id"] == "successPacket":
+                if response is None:
+                    jsonReturn = getQueuedPacket(jsonData)
+                elif response["id"] == "successPacket":
                     jsonReturn = {
                         "id": "successPacket",
                         "data": {
@@ -824,20 +2721,16 @@ def handleRequest(jsonData, handler, ISUDP=False):
                             "id": jsonData["data"]["id"]
                         }
                     }
-                if not ISUDP:
-                    handler.send_response(200)
-                    handler.send_header('Content-type', 'application/json')
-                    handler.end_headers()
-                    handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
             if jsonData["data"]["key"] == "color":
-                lights[jsonData["data"]["name"]].color = LedColor(int(jsonData["data"]["value"][0]),
+                state.lights[jsonData["data"]["name"]].color = LedColor(int(jsonData["data"]["value"][0]),
                                                                   int(jsonData["data"]["value"][1]),
                                                                   int(jsonData["data"]["value"][2]))
-                response = requests.put("http://" + lights[jsonData["data"]["name"]].ip + ":80/diyledapi/" + str(
-                    hex(get_mac())) + "/updateValue", data=json.dumps(jsonData).encode('utf-8'))
-                response = json.loads(response.content.decode('utf-8'))
+                lightChanged(state.lights[jsonData["data"]["name"]])
+                response = putLightValue(state.lights[jsonData["data"]["name"]], jsonData)
                 jsonReturn = ""
-                if response["id"] == "successPacket":
+                if response is None:
+                    jsonReturn = getQueuedPacket(jsonData)
+                elif response["id"] == "successPacket":
                     jsonReturn = {
                         "id": "successPacket",
                         "data": {
@@ -853,14 +2746,9 @@ def handleRequest(jsonData, handler, ISUDP=False):
                             "id": jsonData["data"]["id"]
                         }
                     }
-                if not ISUDP:
-                    handler.send_response(200)
-                    handler.send_header('Content-type', 'application/json')
-                    handler.end_headers()
-                    handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
         if jsonData["data"]["request"] == "scene":
             if jsonData["data"]["key"] == "apply":
-                scenes[jsonData["data"]["name"]].applyScene()
+                state.scenes[jsonData["data"]["name"]].applyScene()
                 jsonReturn = {
                     "id": "successPacket",
                     "data": {
@@ -868,49 +2756,582 @@ def handleRequest(jsonData, handler, ISUDP=False):
                         "id": jsonData["data"]["id"]
                     }
                 }
-                if not ISUDP:
-                    handler.send_response(200)
-                    handler.send_header('Content-type', 'application/json')
-                    handler.end_headers()
-                    handler.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
     return jsonReturn
 
-class httpHandler(BaseHTTPRequestHandler):
-    global appInstances
+class StatusPage():
+    # both variants are rendered once per state version, polling them only costs a version check
+    def __init__(self, site):
+        self.site = site
+        self.text = (None, b"")
+        self.json = (None, b"{}")
 
-    def do_GET(self):
-        path = str(self.path)
-        if DEBUG:
-            print("HTTP: handling request: '" + path + "' from " + str(self.client_address))
-        elif (path.startswith("/diyledstatus")):
-            active = 0
-            dead = 0
-            for app in appInstances:
-                if appInstances[app].DEAD:
-                    dead = dead + 1
-                else:
-                    active = active + 1
-            response = "DiyLed - Status:\r\n\r\nRunning... \r\n%s Lights registered!\r\n%s Rooms registered!\r\n%s Scenes registered!\r\nAppInstances: %s Active, %s Dead\r\n\r\nStates:\r\n" % (
-            str(len(lights)), str(len(rooms)), str(len(scenes)), str(active), str(dead))
-            for lightName in lights:
-                response = response + str(lightName) + " - Power: " + str(
-                    lights[lightName].power).lower() + " | Brightness: " + str(
-                    lights[lightName].brightness) + " | Mode: " + str(lights[lightName].mode) + " | Color: " + str(
-                    lights[lightName].color.r) + ", " + str(lights[lightName].color.g) + ", " + str(
-                    lights[lightName].color.b) + "\r\n"
-            response = response + "\r\n\r\nDiyLed V1.1 by Sebastian Scheibe, 2019"
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(response.encode('utf-8'))
-            return
-        elif (path.startswith("/diyled")):
-            content_len = int(self.headers.get('Content-Length', 0))
-            post_body = self.rfile.read(content_len).decode('utf-8')
-            try:
-                if (json.loads(post_body)):
-                    handleRequest(json.loads(post_body), self)
+    def getText(self):
+        snapshot = state.snapshot()
+        key = (snapshot.version, server.firstStatusTime if server is not None else None)
+        cached = self.text
+        if cached[0] != key:
+            cached = (key, self.renderText(snapshot))
+            self.text = cached
+        return cached[1]
+
+    def getJson(self):
+        snapshot = state.snapshot()
+        key = (snapshot.version, server.firstStatusTime if server is not None else None)
+        cached = self.json
+        if cached[0] != key:
+            cached = (key, self.renderJson(snapshot))
+            self.json = cached
+        # uptime changes on every request, so it is put in front of the cached object instead of into it
+        uptime = time.time() - server.processStartTime if server is not None else 0
+        cache = self.site.requestCache
+        counters = '{"uptime":%.1f,"requests":%d,"errors":%d,"subscribers":%d,"cacheHits":%d,"cacheMisses":%d,' % (
+            uptime, self.site.requests, self.site.errors, self.site.events.count(), cache.hits, cache.misses)
+        return counters.encode('utf-8') + cached[1][1:]
+
+    def countApps(self, snapshot):
+        active = 0
+        dead = 0
+        for app in snapshot.appInstances:
+            if snapshot.appInstances[app].DEAD:
+                dead = dead + 1
+            else:
+                active = active + 1
+        return active, dead
+
+    def renderText(self, snapshot):
+        active, dead = self.countApps(snapshot)
+        lines = ["DiyLed - Status (%s):\r\n\r\nRunning... \r\n%s Lights registered!\r\n%s Rooms registered!\r\n%s Scenes registered!\r\nAppInstances: %s Active, %s Dead\r\n\r\nStates:\r\n" % (
+            self.site.name, str(len(snapshot.lights)), str(len(snapshot.rooms)), str(len(snapshot.scenes)), str(active), str(dead))]
+        for lightName in snapshot.lights:
+            l = snapshot.lights[lightName]
+            lines.append("%s - Power: %s | Brightness: %s | Mode: %s | Color: %s, %s, %s\r\n" % (
+                lightName, str(l.power).lower(), l.brightness, l.mode, l.color.r, l.color.g, l.color.b))
+        if server is not None and server.firstStatusTime is not None:
+            lines.append("\r\nStartup: %.3fs until the first status request" % server.firstStatusTime)
+        lines.append("\r\n\r\nDiyLed V1.1 by Sebastian Scheibe, 2019")
+        return "".join(lines).encode('utf-8')
+
+    def renderJson(self, snapshot):
+        active, dead = self.countApps(snapshot)
+        lightStates = []
+        for lightName in snapshot.lights:
+            l = snapshot.lights[lightName]
+            lightStates.append({
+                "name": lightName,
+                "power": l.power,
+                "brightness": l.brightness,
+                "mode": l.mode,
+                "color": [l.color.r, l.color.g, l.color.b],
+                "health": l.getHealth(),
+                "lastSeen": l.lastSeen
+            })
+        data = {
+            "version": "1.1",
+            "site": self.site.name,
+            "startup": server.firstStatusTime if server is not None else None,
+            "lights": len(snapshot.lights),
+            "rooms": len(snapshot.rooms),
+            "scenes": len(snapshot.scenes),
+            "schedules": len(snapshot.schedules),
+            "apps": {"active": active, "dead": dead},
+            "reconciliation": self.site.reconciliation.getMetrics() if self.site.reconciliation else None,
+            "states": lightStates
+        }
+        return jsonDumps(data)
+
+class EventChannel():
+    # the server-sent events of one site, its sockets are served by the shared EventStream
+    def __init__(self, stream):
+        self.stream = stream
+        self.backlog = deque(maxlen=EVENT_BACKLOG)  # (id, message) for clients resuming with Last-Event-ID
+        self.lastId = 0
+        self.sockets = set()
+
+    def publish(self, event, data):
+        with self.stream.lock:
+            self.lastId = self.lastId + 1
+            message = b"id: %d\nevent: %s\ndata: %s\n\n" % (self.lastId, event.encode('utf-8'), jsonDumps(data))
+            self.backlog.append((self.lastId, message))
+            if not self.sockets:
+                return
+            self.stream.queue(self.sockets, message)
+        self.stream.wakeup()
+
+    def subscribe(self, sock, lastEventId=None):
+        # the socket belongs to the stream afterwards, events the client missed are sent first
+        sock.setblocking(False)
+        pending = bytearray(b"retry: %d\n\n" % EVENT_RETRY)
+        with self.stream.lock:
+            if lastEventId is not None and lastEventId != self.lastId:
+                if self.backlog and self.backlog[0][0] - 1 <= lastEventId < self.lastId:
+                    for eventId, message in self.backlog:
+                        if eventId > lastEventId:
+                            pending += message
+                else:
+                    # too old or from before a restart, the client has to fetch everything again
+                    pending += b"id: %d\nevent: reset\ndata: {}\n\n" % self.lastId
+            self.sockets.add(sock)
+            self.stream.add(sock, self, pending)
+        self.stream.wakeup()
+
+    def count(self):
+        return len(self.sockets)
+
+
+class EventStream():
+    # the http handler only writes the headers and hands its socket over, from then on one selector thread
+    # serves every subscriber of every site, idle or not
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lastKeepalive = time.monotonic()
+        self.subscribers = {}  # socket -> bytearray of data the socket did not take yet
+        self.channels = {}  # socket -> EventChannel
+        self.dirty = set()  # sockets with new data or new subscribers, picked up by the thread
+        self.closing = set()
+        self.selector = selectors.DefaultSelector()
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+        self.wakeupWriter.setblocking(False)
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ)
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wakeup(self):
+        try:
+            self.wakeupWriter.send(b"\0")
+        except BlockingIOError:
+            pass  # the thread has not read the last wakeup yet, one is enough
+
+    def add(self, sock, channel, pending):
+        # called with the lock held
+        self.subscribers[sock] = pending
+        self.channels[sock] = channel
+        self.dirty.add(sock)
+
+    def queue(self, sockets, message):
+        # called with the lock held
+        for sock in sockets:
+            pending = self.subscribers[sock]
+            pending += message
+            if len(pending) > EVENT_MAX_PENDING:
+                self.closing.add(sock)  # the client resumes from the backlog once it reconnects
+            self.dirty.add(sock)
+
+    def close(self, sock):
+        with self.lock:
+            self.subscribers.pop(sock, None)
+            channel = self.channels.pop(sock, None)
+            if channel is not None:
+                channel.sockets.discard(sock)
+            self.dirty.discard(sock)
+            self.closing.discard(sock)
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+    def flush(self, sock):
+        # returns True while data is left for the socket
+        with self.lock:
+            pending = self.subscribers.get(sock)
+            if pending is None:
+                return False
+            try:
+                sent = sock.send(pending)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.closing.add(sock)
+                return False
+            del pending[:sent]
+            return len(pending) > 0
+
+    def watch(self, sock, writing):
+        mask = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+        try:
+            if self.selector.get_key(sock).events != mask:
+                self.selector.modify(sock, mask)
+        except KeyError:
+            self.selector.register(sock, mask)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if time.monotonic() - self.lastKeepalive >= EVENT_KEEPALIVE:
+                    self.lastKeepalive = time.monotonic()
+                    self.queue(list(self.subscribers), b": keepalive\n\n")  # lets proxies see the stream is alive
+                dirty = self.dirty
+                self.dirty = set()
+                closing = self.closing
+                self.closing = set()
+            for sock in closing:
+                self.close(sock)
+            for sock in dirty:
+                if sock in self.subscribers:
+                    self.watch(sock, self.flush(sock))
+            for key, mask in self.selector.select(EVENT_KEEPALIVE):
+                sock = key.fileobj
+                if sock is self.wakeupReader:
+                    try:
+                        while sock.recv(512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if mask & selectors.EVENT_READ:
+                    # clients never send anything after their request, readable means closed
+                    try:
+                        data = sock.recv(512)
+                    except (BlockingIOError, InterruptedError):
+                        data = None
+                    except OSError:
+                        data = b""
+                    if data == b"":
+                        self.close(sock)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    self.watch(sock, self.flush(sock))
+
+class Framebuffer():
+    # three preallocated buffers per light: the ingest writes into one, one holds the newest complete frame and
+    # the sender thread sends the third. Passing a frame on only swaps their indexes, a frame that is replaced
+    # before it was sent counts as dropped
+    def __init__(self, site, name, ledCount):
+        self.site = site
+        self.name = name
+        self.ledCount = ledCount
+        self.size = ledCount * 3
+        self.lock = threading.Lock()  # held by the writer of a frame until it is committed
+        self.buffers = [bytearray(self.size) for i in range(3)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+        self.writing, self.ready, self.sending = 0, 1, 2
+        self.fresh = False
+        self.sequence = 0
+        offsets = range(0, self.size, FRAME_MAX_DATA)
+        self.headers = [bytearray(10) for offset in offsets]
+        # header and pixels of every datagram of every buffer, prepared once so sending allocates nothing
+        self.messages = [[[self.headers[i], view[offset:offset + FRAME_MAX_DATA]] for i, offset in enumerate(offsets)]
+                         for view in self.views]
+        self.received = 0
+        self.sent = 0
+        self.dropped = 0
+        self.invalid = 0
+        self.errors = 0
+        self.fps = 0.0
+        self.rateTime = time.monotonic()
+        self.rateSent = 0
+
+    def getTarget(self):
+        # the buffer the next frame is written into, only with the lock held
+        return self.views[self.writing]
+
+    def getMetrics(self):
+        return {
+            "ledCount": self.ledCount,
+            "received": self.received,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "invalid": self.invalid,
+            "errors": self.errors,
+            "fps": self.fps if time.monotonic() - self.rateTime < 2 else 0.0
+        }
+
+
+class FrameStream():
+    # per led pixel data for the lights. Frames come in as raw RGB over udp (a length byte, the light's name,
+    # then 3 bytes per led) or as the body of PUT /diyledframe/<light>, and go out to the lights as DDP
+    # datagrams on port 4048. Only the newest frame of a light is sent, the sender never waits for the ingest
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.buffers = {}  # (site name, light name) -> Framebuffer
+        self.pending = deque()  # framebuffers with a fresh frame
+        self.invalid = 0  # frames for unknown lights
+        self.out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def start(self, port=FRAME_INGEST_PORT):
+        t = threading.Thread(target=self.send)
+        t.daemon = True
+        t.start()
+        t = threading.Thread(target=self.receive, args=(port,))
+        t.daemon = True
+        t.start()
+
+    def get(self, site, name):
+        light = site.state.lights.get(name) if site is not None else None
+        if light is None:
+            with self.condition:
+                self.invalid = self.invalid + 1
+            return None
+        key = (site.name, name)
+        with self.condition:
+            frames = self.buffers.get(key)
+            if frames is None or frames.ledCount != int(light.ledCount):
+                frames = Framebuffer(site, name, int(light.ledCount))
+                self.buffers[key] = frames
+            return frames
+
+    def discard(self, site, name):
+        with self.condition:
+            self.buffers.pop((site.name, name), None)
+
+    def commit(self, frames):
+        # called by the writer with the lock of the framebuffer held
+        with self.condition:
+            frames.writing, frames.ready = frames.ready, frames.writing
+            frames.received = frames.received + 1
+            if frames.fresh:
+                frames.dropped = frames.dropped + 1
+                return
+            frames.fresh = True
+            self.pending.append(frames)
+            self.condition.notify()
+
+    def send(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                frames = self.pending.popleft()
+                frames.ready, frames.sending = frames.sending, frames.ready
+                frames.fresh = False
+            light = frames.site.state.lights.get(frames.name)
+            if light is None:
+                continue
+            messages = frames.messages[frames.sending]
+            frames.sequence = frames.sequence % 15 + 1
+            try:
+                for i, message in enumerate(messages):
+                    # DDP header: version 1 (push on the last datagram), sequence, RGB 8 bit, output 1, offset, length
+                    struct.pack_into("!BBBBLH", message[0], 0, 0x41 if i == len(messages) - 1 else 0x40,
+                                     frames.sequence, 0x0B, 1, i * FRAME_MAX_DATA, len(message[1]))
+                    self.out.sendmsg(message, (), 0, (light.ip, FRAME_PORT))
+                frames.sent = frames.sent + 1
+            except OSError:
+                frames.errors = frames.errors + 1
+            now = time.monotonic()
+            if now - frames.rateTime >= 1:
+                frames.fps = (frames.sent - frames.rateSent) / (now - frames.rateTime)
+                frames.rateTime = now
+                frames.rateSent = frames.sent
+
+    def receive(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('', port))
+        head = bytearray(256)
+        headViews = [memoryview(head)[:length] for length in range(257)]
+        scratch = bytearray(65536)
+        while True:
+            try:
+                received = sock.recv_into(head, 256, socket.MSG_PEEK)
+                nameLength = head[0] if received else 0
+                name = head[1:1 + nameLength].decode('utf-8', 'replace')
+                frames = self.get(siteOfLight(name, None), name) if received > nameLength else None
+                if frames is None:
+                    sock.recv_into(scratch)
+                    continue
+                with frames.lock:
+                    # name and pixels go straight into their buffers
+                    received, ancdata, flags, address = sock.recvmsg_into([headViews[1 + nameLength],
+                                                                           frames.getTarget()])
+                    if received != 1 + nameLength + frames.size or flags & socket.MSG_TRUNC:
+                        frames.invalid = frames.invalid + 1
+                        continue
+                    self.commit(frames)
+            except OSError as e:
+                if DEBUG:
+                    print("FRAMES: error receiving a frame")
+                    print(e)
+
+    def getMetrics(self, site):
+        with self.condition:
+            return {
+                "port": FRAME_INGEST_PORT,
+                "invalid": self.invalid,
+                "lights": dict((name, self.buffers[(siteName, name)].getMetrics())
+                               for siteName, name in self.buffers if siteName == site.name)
+            }
+
+
+def getSetupPackets(snapshot, packetId):
+    lightInfoPackets = []
+    for name in snapshot.lights:
+        lightInfoPackets.append(snapshot.lights[name].getInfoPacket())
+    roomInfoPackets = []
+    for name in snapshot.rooms:
+        roomInfoPackets.append(snapshot.rooms[name].getInfoPacket())
+    sceneInfoPackets = []
+    for name in snapshot.scenes:
+        sceneInfoPackets.append(snapshot.scenes[name].getInfoPacket())
+    jsonReturn = {
+        "id": "setupPackets",
+        "data": [
+            {
+                "id": "allLightsPacket",
+                "data": {
+                    "lights": lightInfoPackets,
+                    "id": packetId
+                }
+            },
+            {
+                "id": "allRoomsPacket",
+                "data": {
+                    "rooms": roomInfoPackets,
+                    "id": packetId
+                }
+            },
+            {
+                "id": "allScenesPacket",
+                "data": {
+                    "scenes": sceneInfoPackets,
+                    "id": packetId
+                }
+            }
+        ]
+    }
+    return jsonReturn
+
+class httpHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.routeRequest(self.handleGet)
+
+    def do_PUT(self):
+        self.routeRequest(self.handlePut)
+
+    def routeRequest(self, method):
+        # sites are picked by the path prefix /site/<name>/..., then by the host header, anything else
+        # belongs to the default site
+        path = str(self.path)
+        if path.startswith("/site/"):
+            parts = path.split("/", 3)
+            site = sites.get(parts[2])
+            path = "/" + (parts[3] if len(parts) > 3 else "")
+        else:
+            site = siteHosts.get(self.headers.get("Host", "").split(":")[0].lower(), defaultSite)
+        if site is None:
+            self.send_response(404)
+            self.send_header('Content-type', 'text/html')
+            self.end_headers()
+            self.wfile.write(("ERROR").encode('utf-8'))
+            return
+        if standby is not None and standby.following and not path.startswith(("/diyledstatus", "/diyledsites",
+                                                                              "/diyledreplication",
+                                                                              "/diyledworkers")):
+            self.send_response(503)  # the primary is still alive, apps have to talk to it
+            self.send_header('Retry-After', str(REPLICATION_TIMEOUT))
+            self.end_headers()
+            return
+        site.countRequest()
+        with activeSite(site), trace(self.command + " " + path.split("?", 1)[0],
+                                     force=self.headers.get("X-DiyLed-Trace") == "1", client=self.client_address[0]):
+            appSeen(self.client_address[0])
+            try:
+                method(path)
+            except Exception:
+                site.countError()
+                raise
+
+    def handleGet(self, path):
+        if DEBUG:
+            print("HTTP: handling request: '" + path + "' from " + str(self.client_address))
+        if (path.startswith("/diyledstatus/json")):
+            self.send_response(200)
+            body = statusPage.getJson()
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        elif (path.startswith("/diyledevents")):
+            lastEventId = self.headers.get("Last-Event-ID")
+            if lastEventId is None and "lastEventId=" in path:
+                lastEventId = path.split("lastEventId=", 1)[1].split("&", 1)[0]
+            try:
+                lastEventId = int(lastEventId) if lastEventId is not None else None
+            except ValueError:
+                lastEventId = None
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            # the stream keeps the connection, this thread is done with it
+            self.close_connection = True
+            events.subscribe(socket.socket(fileno=self.connection.detach()), lastEventId)
+            return
+        elif (path.startswith("/diyledtraces")):
+            limit = TRACE_BUFFER
+            if "limit=" in path:
+                try:
+                    limit = max(0, int(path.split("limit=", 1)[1].split("&", 1)[0]))
+                except ValueError:
+                    self.send_response(400)
+                    self.send_header('Content-type', 'text/html')
+                    self.end_headers()
+                    self.wfile.write(("ERROR: limit has to be a number").encode('utf-8'))
+                    return
+            sendJson(self, tracer.getTraces(limit))
+            return
+        elif (path.startswith("/diyledreplication")):
+            sendJson(self, getReplicationMetrics())
+            return
+        elif (path.startswith("/diyledhistory")):
+            # ?from=<unix time>&to=<unix time>&light=<name> or &room=<name>, the last 24 hours of all lights by default
+            query = dict(part.split("=", 1) for part in path.partition("?")[2].split("&") if "=" in part)
+            try:
+                end = float(query.get("to", time.time()))
+                start = float(query.get("from", end - 86400))
+            except ValueError:
+                self.send_response(400)
+                self.send_header('Content-type', 'text/html')
+                self.end_headers()
+                self.wfile.write(("ERROR: from and to have to be unix times").encode('utf-8'))
+                return
+            light = unquote(query["light"]) if "light" in query else None
+            room = unquote(query["room"]) if "room" in query else None
+            sendJson(self, getHistory(state.snapshot(), start, end, light, room))
+            return
+        elif (path.startswith("/diyledapps")):
+            snapshot = state.snapshot()
+            sendJson(self, {
+                "apps": [{"ip": app.ip, "lastSeen": app.lastSeen, "dead": app.DEAD}
+                         for app in snapshot.appInstances.values()],
+                "notifications": appNotifier.getMetrics()
+            })
+            return
+        elif (path.startswith("/diyledframes")):
+            sendJson(self, frameStream.getMetrics(currentSite()))
+            return
+        elif (path.startswith("/diyledworkers")):
+            sendJson(self, workerPool.getMetrics())
+            return
+        elif (path.startswith("/diyledsites")):
+            sendJson(self, {"sites": [sites[name].getMetrics() for name in sites]})
+            return
+        elif (path.startswith("/diyledstatus")):
+            body = statusPage.getText()
+            self.send_response(200)
+            self.send_header('Content-type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if server is not None:
+                server.firstStatusServed()
+            return
+        elif (path.startswith("/diyled")):
+            try:
+                jsonData = readJson(self)
+                if (jsonData):
+                    handleRequest(jsonData, self)
             except Exception as e:
+                currentSite().countError()
                 if DEBUG:
                     print("HTTP: error handling '/diyled' request from " + str(self.client_address))
                     print(e)
@@ -923,29 +3344,49 @@ class httpHandler(BaseHTTPRequestHandler):
         self.wfile.write(("ERROR").encode('utf-8'))
         return
 
-    def do_PUT(self):
-        path = str(self.path)
+    def handlePut(self, path):
+        if (path.startswith("/diyledframe/")):
+            # frames come many times a second, they skip the debug output and get no json answer
+            frames = frameStream.get(currentSite(), unquote(path[len("/diyledframe/"):].split("?", 1)[0]))
+            length = int(self.headers.get('Content-Length', 0))
+            if frames is None or length != frames.size:
+                self.rfile.read(length)
+                if frames is not None:
+                    frames.invalid = frames.invalid + 1
+                self.send_response(404 if frames is None else 400)
+                self.end_headers()
+                return
+            with frames.lock:
+                # the body can arrive in several pieces, a frame that ends early is dropped and not sent half old
+                target = frames.getTarget()
+                received = 0
+                while received < length:
+                    n = self.rfile.readinto(target[received:])
+                    if not n:
+                        break
+                    received = received + n
+                if received == length:
+                    frameStream.commit(frames)
+                else:
+                    frames.invalid = frames.invalid + 1
+            self.send_response(204 if received == length else 400)
+            self.end_headers()
+            return
         if DEBUG:
             print("HTTP: handling request: '" + path + "' from " + str(self.client_address))
         if (path.startswith("/diyledinfo")):
-            content_len = int(self.headers.get('Content-Length', 0))
-            post_body = self.rfile.read(content_len).decode('utf-8')
-            if (json.loads(post_body)):
+            jsonData = readJson(self)
+            if (jsonData):
                 print(self.client_address)
-                handleRequest(json.loads(post_body), self)
+                handleRequest(jsonData, self)
             return
         elif (path.startswith("/diyleddiscover")):
-            content_len = int(self.headers.get('Content-Length', 0))
-            post_body = self.rfile.read(content_len).decode('utf-8')
-            if (json.loads(post_body)):
-                jsonData = json.loads(post_body)
+            jsonData = readJson(self)
+            if (jsonData):
                 ip, port = self.client_address
-                print(appInstances.keys())
-                appInstances[str(ip)].DISCOVER = True
-                searching = True
-                t = threading.Thread(target=searchTimer)
-                t.daemon = True
-                t.start()
+                print(state.appInstances.keys())
+                registerApp(str(ip)).DISCOVER = True
+                startSearch()
                 jsonReturn = {
                     "id": "successPacket",
                     "data": {
@@ -953,70 +3394,35 @@ class httpHandler(BaseHTTPRequestHandler):
                         "id": jsonData["id"]
                     }
                 }
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
+                sendJson(self, jsonReturn)
         elif (path.startswith("/diyledapp")):
-            content_len = int(self.headers.get('Content-Length', 0))
-            post_body = self.rfile.read(content_len).decode('utf-8')
-            if (json.loads(post_body)):
+            jsonData = readJson(self)
+            if (jsonData):
+                ip, port = self.client_address
+                registerApp(ip)
+                sendJson(self, getSetupPackets(state.snapshot(), jsonData["id"]))
+                return
+        elif (path.startswith("/diyledheartbeat")):
+            jsonData = readJson(self)
+            if (jsonData):
                 ip, port = self.client_address
-                appInstances[ip] = AppInstance(ip)
-                jsonData = json.loads(post_body)
-                lightInfoPackets = []
-                for name in lights:
-                    lightInfoPackets.append(lights[name].getInfoPacket())
-                roomInfoPackets = []
-                for name in rooms:
-                    roomInfoPackets.append(rooms[name].getInfoPacket())
-                sceneInfoPackets = []
-                for name in scenes:
-                    sceneInfoPackets.append(scenes[name].getInfoPacket())
+                registerApp(ip)
                 jsonReturn = {
-                    "id": "setupPackets",
-                    "data": [
-                        {
-                            "id": "allLightsPacket",
-                            "data": {
-                                "lights": lightInfoPackets,
-                                "id": jsonData["id"]
-                            }
-                        },
-                        {
-                            "id": "allRoomsPacket",
-                            "data": {
-                                "rooms": roomInfoPackets,
-                                "id": jsonData["id"]
-                            }
-                        },
-                        {
-                            "id": "allScenesPacket",
-                            "data": {
-                                "scenes": sceneInfoPackets,
-                                "id": jsonData["id"]
-                            }
-                        }
-                    ]
+                    "id": "successPacket",
+                    "data": {
+                        "message": "Verbunden.",
+                        "id": jsonData["id"]
+                    }
                 }
-                self.send_response(200)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(jsonReturn).encode('utf-8'))
+                sendJson(self, jsonReturn)
                 return
         elif (path.startswith("/diyled")):
-            content_len = int(self.headers.get('Content-Length', 0))
-            post_body = self.rfile.read(content_len).decode('utf-8')
-            if (json.loads(post_body)):
+            jsonData = readJson(self)
+            if (jsonData):
                 print(self.client_address)
-                handleRequest(json.loads(post_body), self)
-                ip, port = self.client_address
-                for app in appInstances:
-                    if appInstances[app].ip != ip:
-                        jsonData = {
-                            "id": "getSetupPackets"
-                        }
-                        appInstances[app].sendMessage(json.dumps(jsonData))
+                if handleRequest(jsonData, self) is not None:
+                    ip, port = self.client_address
+                    notifyApps(ip)
             return
         if DEBUG:
             print("HTTP: error handling request from " + str(self.client_address))
@@ -1026,12 +3432,215 @@ class httpHandler(BaseHTTPRequestHandler):
         self.wfile.write(("ERROR").encode('utf-8'))
         return
 
-class ThreadedHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
-    pass
+class WorkerPool():
+    # a fixed number of threads handles the http requests. New connections first wait in one selector thread
+    # until their request arrived, a peek at it decides the lane: changeValueRequestPackets (an app toggling a
+    # light) are interactive and always go first, everything else (setupPackets, info, discovery, status pages)
+    # is bulk. A full lane answers 503 right away instead of piling up threads
+    LANES = ("interactive", "bulk")
+
+    def __init__(self, server, workers=HTTP_WORKERS, queueSize=HTTP_QUEUE_SIZE):
+        self.server = server
+        self.workers = max(1, workers)
+        # with only a few workers at least one of them has to be left for the bulk lane
+        self.reserved = max(0, min(HTTP_RESERVED_WORKERS, self.workers - 1))
+        self.queueSize = queueSize
+        self.condition = threading.Condition()
+        self.queues = {lane: deque() for lane in self.LANES}
+        self.busy = 0
+        self.stats = {lane: {"handled": 0, "rejected": 0, "maxWait": 0.0, "waits": deque(maxlen=HTTP_WAIT_SAMPLES)}
+                      for lane in self.LANES}
+        self.incoming = deque()  # accepted connections, handed to the sorting thread
+        self.sorting = {}  # socket -> (address, accepted)
+        self.partial = set()  # sockets with the start of a request, looked at again shortly
+        self.selector = selectors.DefaultSelector()
+        self.wakeupReader, self.wakeupWriter = socket.socketpair()
+        self.wakeupReader.setblocking(False)
+        self.wakeupWriter.setblocking(False)
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ)
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+        t = threading.Thread(target=self.sort)
+        t.daemon = True
+        t.start()
+
+    def submit(self, sock, address):
+        # called by the accepting thread, must not block
+        self.incoming.append((sock, address, time.monotonic()))
+        try:
+            self.wakeupWriter.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    @staticmethod
+    def isComplete(data):
+        head, separator, body = data.partition(b"\r\n\r\n")
+        if not separator:
+            return False
+        for line in head.split(b"\r\n"):
+            if line[:15].lower() == b"content-length:":
+                try:
+                    return len(body) >= int(line[15:])
+                except ValueError:
+                    return True
+        return True
+
+    @staticmethod
+    def getLane(data):
+        return "interactive" if b"changeValueRequestPacket" in data else "bulk"
+
+    def sort(self):
+        while True:
+            # many clients write the headers and the body separately, the body follows within a millisecond
+            events = self.selector.select(0.001 if self.partial else 1)
+            for key, mask in events:
+                if key.fileobj is self.wakeupReader:
+                    try:
+                        while self.wakeupReader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.peek(key.fileobj)
+            while self.incoming:
+                sock, address, accepted = self.incoming.popleft()
+                if len(self.sorting) >= HTTP_MAX_CONNECTIONS:
+                    self.reject(sock, "bulk")
+                    continue
+                sock.setblocking(False)
+                self.sorting[sock] = (address, accepted)
+                self.selector.register(sock, selectors.EVENT_READ)
+            for sock in list(self.partial):
+                self.peek(sock)
+            now = time.monotonic()
+            for sock in [sock for sock in self.sorting if now - self.sorting[sock][1] > HTTP_IDLE_TIMEOUT]:
+                self.release(sock)
+                self.server.shutdown_request(sock)
+
+    def peek(self, sock):
+        address, accepted = self.sorting[sock]
+        try:
+            data = sock.recv(HTTP_PEEK_SIZE, socket.MSG_PEEK)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.release(sock)  # closed before it sent anything
+            self.server.shutdown_request(sock)
+            return
+        if (not self.isComplete(data) and len(data) < HTTP_PEEK_SIZE
+                and time.monotonic() - accepted < HTTP_SORT_WAIT):
+            if sock not in self.partial:
+                # the socket stays readable until the request is read, it is polled instead of watched
+                self.selector.unregister(sock)
+                self.partial.add(sock)
+            return
+        self.release(sock)
+        sock.setblocking(True)
+        self.queue(sock, address, accepted, self.getLane(data))
+
+    def release(self, sock):
+        del self.sorting[sock]
+        if sock in self.partial:
+            self.partial.discard(sock)
+        else:
+            self.selector.unregister(sock)
+
+    def queue(self, sock, address, accepted, lane):
+        with self.condition:
+            if len(self.queues[lane]) < self.queueSize:
+                self.queues[lane].append((sock, address, accepted, lane))
+                self.condition.notify()
+                return
+        self.reject(sock, lane)
+
+    def reject(self, sock, lane):
+        with self.condition:
+            self.stats[lane]["rejected"] = self.stats[lane]["rejected"] + 1
+        try:
+            sock.setblocking(False)
+            while sock.recv(HTTP_PEEK_SIZE):
+                pass  # unread data would turn the close into a reset and the client would not see the 503
+        except OSError:
+            pass
+        try:
+            sock.send(HTTP_REJECT)
+        except OSError:
+            pass
+        self.server.shutdown_request(sock)
+
+    def next(self):
+        # called with the condition held, bulk work only gets the workers that are not reserved
+        if self.queues["interactive"]:
+            return self.queues["interactive"].popleft()
+        if self.queues["bulk"] and self.busy < self.workers - self.reserved:
+            return self.queues["bulk"].popleft()
+        return None
+
+    def work(self):
+        while True:
+            with self.condition:
+                item = self.next()
+                while item is None:
+                    self.condition.wait()
+                    item = self.next()
+                sock, address, accepted, lane = item
+                self.busy = self.busy + 1
+                wait = time.monotonic() - accepted
+                stats = self.stats[lane]
+                stats["handled"] = stats["handled"] + 1
+                stats["waits"].append(wait)
+                stats["maxWait"] = max(stats["maxWait"], wait)
+            try:
+                self.server.finish_request(sock, address)
+            except Exception:
+                self.server.handle_error(sock, address)
+            finally:
+                self.server.shutdown_request(sock)
+                with self.condition:
+                    self.busy = self.busy - 1
+
+    def getMetrics(self):
+        with self.condition:
+            lanes = {}
+            for lane in self.LANES:
+                stats = self.stats[lane]
+                waits = sorted(stats["waits"])
+                lanes[lane] = {
+                    "queued": len(self.queues[lane]),
+                    "handled": stats["handled"],
+                    "rejected": stats["rejected"],
+                    "wait": {
+                        "avg": sum(waits) / len(waits),
+                        "p99": waits[min(len(waits) - 1, int(len(waits) * 0.99))],
+                        "max": stats["maxWait"]
+                    } if waits else None
+                }
+            return {"workers": self.workers, "reserved": self.reserved, "busy": self.busy,
+                    "connecting": len(self.sorting), "lanes": lanes}
+
+
+class ThreadedHTTPServer(HTTPServer):
+    request_queue_size = 128  # event stream clients tend to reconnect all at once
+
+    def __init__(self, address, handler, workers=HTTP_WORKERS):
+        HTTPServer.__init__(self, address, handler)
+        self.pool = WorkerPool(self, workers)
+        self.pool.start()
 
-def startHTMLServer():
-    server = ThreadedHTTPServer(('', 80), httpHandler)
-    tServer = threading.Thread(target=server.serve_forever)
+    def process_request(self, request, client_address):
+        self.pool.submit(request, client_address)
+
+def startHTMLServer(port=80, workers=HTTP_WORKERS):
+    global workerPool
+    httpServer = ThreadedHTTPServer(('', port), httpHandler, workers)
+    workerPool = httpServer.pool
+    tServer = threading.Thread(target=httpServer.serve_forever)
     tServer.daemon = True
     tServer.start()
     if DEBUG:
@@ -1065,10 +3674,6 @@ def get_ip():
 
 def handleUDP():
     global udp
-    global lights
-    global config
-    global newLights
-    global searching
     while True:
         request, request_addr = udp.recvfrom(1024)
         request = request.decode('utf-8')
@@ -1078,32 +3683,291 @@ def handleUDP():
             if (request.find("HTTP/1.1 200 OK") >= 0) and (request.find("urn:diyleddevice:light") >= 0):
                 s = request.split("\r\n")
                 address = s[3].split("LOCATION: ")[1]
+                if any(site.reconciliation is not None and site.reconciliation.answer(request_addr[0], address)
+                       for site in list(sites.values())):
+                    continue  # fetched by a worker of the reconciliation
                 try:
-                    response = requests.get(address)
-                    conf = response.json()
+                    response = getRequests().get(address, timeout=LIGHT_TIMEOUT)
+                    conf = jsonLoads(response.content)
                     if DEBUG:
                         print("UDP: responding 'HTTP/1.1 200 OK' of " + str(request_addr))
-                    handleRequest(conf, None, ISUDP=True)
-                    if searching:
-                        newLights.append(conf["data"]["name"])
+                    site = siteOfLight(conf["data"]["name"], request_addr[0])
+                    with activeSite(site), trace("UDP registration", light=conf["data"]["name"]):
+                        handleRequest(conf, None, ISUDP=True)
+                        pushGroups([conf["data"]["name"]])  # nobody reads the answer of this registration
+                    if site.searching:
+                        site.newLights.append(conf["data"]["name"])
                 except Exception as e:
                     if DEBUG:
                         print(e)
             elif (request.find("M-SEARCH * HTTP/1.1") >= 0) and (request.find("urn:diyleddevice:server") >= 0):
                 print(request)
                 localIP = get_ip()
-                response = "\r\n".join([
-                    'HTTP/1.1 200 OK',
-                    'EXT:',
-                    'CACHE-CONTROL: max-age=100',
-                    'LOCATION: http://' + localIP + ':80/diyledapp',
-                    'SERVER: DiyLed/1.1, UPnP/1.0, DiyLedServer/1.1',
-                    'ST: urn:diyleddevice:server',
-                    'USN: uuid:' + str(hex(get_mac())) + '::urn:diyleddevice', '', ''])
                 ip, port = request_addr
                 if DEBUG:
                     print("UDP: responding 'M-SEARCH * HTTP/1.1' of " + str(request_addr))
-                udp.sendto(response.encode('utf-8'), (ip, port))
+                for site in list(sites.values()):
+                    # one answer per site, apps pick theirs by the usn
+                    response = "\r\n".join([
+                        'HTTP/1.1 200 OK',
+                        'EXT:',
+                        'CACHE-CONTROL: max-age=100',
+                        'LOCATION: http://' + localIP + ':80' + site.prefix + '/diyledapp',
+                        'SERVER: DiyLed/1.1, UPnP/1.0, DiyLedServer/1.1',
+                        'ST: urn:diyleddevice:server',
+                        'USN: uuid:' + str(hex(get_mac())) + site.usnSuffix + '::urn:diyleddevice', '', ''])
+                    udp.sendto(response.encode('utf-8'), (ip, port))
+            elif request.startswith("{"):
+                try:
+                    jsonData = jsonLoads(request)
+                    if jsonData["id"] == "ackPacket":  # a light confirms a room datagram
+                        acknowledgeGroupCommand(jsonData["data"]["token"], jsonData["data"]["name"])
+                except Exception as e:
+                    if DEBUG:
+                        print(e)
+
+class GroupCommand():
+    def __init__(self, token, room, pending, fallback, keys):
+        self.token = token
+        self.site = currentSite()
+        self.room = room
+        self.keys = keys  # what the datagram changes, an ack clears these from the outbox of the light
+        self.pending = set(pending)
+        self.fallback = fallback
+        self.sent = time.time()
+
+def allocateGroupAddress():
+    snapshot = state.snapshot()
+    used = set()
+    for name in snapshot.rooms:
+        used.add(snapshot.rooms[name].group)
+    for i in range(1, 255):
+        if ROOM_GROUP_PREFIX + str(i) not in used:
+            return ROOM_GROUP_PREFIX + str(i)
+    return None
+
+def getGroupsOfLight(light):
+    groups = []
+    for name in light.rooms:
+        room = state.rooms.get(name)
+        if room is not None and room.group is not None:
+            groups.append({"room": name, "address": room.group, "port": ROOM_GROUP_PORT})
+    return groups
+
+def pushGroups(lightNames):
+    # the light gets the full list of its groups, it joins the new ones and leaves the ones that aren't listed.
+    # The puts run on their own thread, a light that is offline gets its groups when it registers again
+    if not lightNames or (standby is not None and standby.following):
+        return
+    t = threading.Thread(target=runGroupPush, args=(currentSite(), list(lightNames)))
+    t.daemon = True
+    t.start()
+
+def runGroupPush(site, lightNames):
+    with activeSite(site):
+        for lightName in lightNames:
+            light = state.lights.get(lightName)
+            if light is None or not light.ip:
+                continue
+            jsonData = {
+                "id": "groupsPacket",
+                "data": {
+                    "groups": getGroupsOfLight(light),
+                    "id": hex(get_mac())
+                }
+            }
+            try:
+                putLight(light, "updateGroups", jsonData)
+            except Exception as e:
+                if DEBUG:
+                    print("HTTP: couldn't send the groups to " + lightName)
+                    print(e)
+
+def sendGroupCommand(room, packetId, data, fallback, pending=None):
+    # one datagram for the whole room, lights that don't ack in time get the unicast request instead
+    global groupCounter
+    if room.group is None or udp is None:
+        return False
+    with groupLock:
+        groupCounter = groupCounter + 1
+        token = hex(groupCounter)
+    data = dict(data)
+    data["id"] = hex(get_mac())
+    data["token"] = token
+    payload = jsonDumps({"id": packetId, "data": data})
+    if len(payload) > GROUP_MAX_DATAGRAM:
+        return False
+    command = GroupCommand(token, room.name, room.lights if pending is None else pending, fallback,
+                           LightOutbox.getKeys(packetId, data))
+    with groupLock:
+        groupCommands[token] = command
+    try:
+        with span("group", room=room.name, lights=len(command.pending)):
+            udp.sendto(payload, (room.group, ROOM_GROUP_PORT))
+    except OSError as e:
+        with groupLock:
+            del groupCommands[token]
+        if DEBUG:
+            print("UDP: couldn't send to group " + room.group + " of " + room.name)
+            print(e)
+        return False
+    scheduler.callLater(GROUP_ACK_TIMEOUT, finishGroupCommand, token)
+    return True
+
+def acknowledgeGroupCommand(token, lightName):
+    with groupLock:
+        command = groupCommands.get(token)
+        if command is not None:
+            command.pending.discard(lightName)
+            if not command.pending:
+                del groupCommands[token]
+    if command is None:
+        return
+    with activeSite(command.site):
+        if state.lights.get(lightName) is not None:
+            state.lights[lightName].lastSeen = time.time()
+            state.lights[lightName].failures = 0
+            outbox.delivered(state.lights[lightName], command.keys)
+            lightIndex.update(state.lights[lightName])
+            state.touch()
+
+def finishGroupCommand(token):
+    with groupLock:
+        command = groupCommands.pop(token, None)
+    if command is None or not command.pending:
+        return
+    if DEBUG:
+        print("UDP: no ack from " + str(len(command.pending)) + " lights of " + command.room + ", sending unicast")
+    t = threading.Thread(target=runGroupFallback, args=(command,))
+    t.daemon = True
+    t.start()
+
+def runGroupFallback(command):
+    with activeSite(command.site):
+        for lightName in command.pending:
+            if lightName not in state.lights:
+                continue
+            try:
+                command.fallback(lightName)
+            except Exception as e:
+                if DEBUG:
+                    print("HTTP: couldn't reach " + lightName)
+                    print(e)
+
+class Reconciliation():
+    # at startup every known light is asked at its last ip (a unicast M-SEARCH, the answers come in through
+    # handleUDP) and a few workers fetch the states of the lights that answered. Runs in the background, lights
+    # that stay silent are marked unreachable
+    def __init__(self, site):
+        self.site = site
+        self.condition = threading.Condition()
+        self.waiting = {}  # ip -> name of the light that did not answer yet
+        self.fetching = deque()  # (name, location) of lights that answered, None stops a worker
+        self.running = False
+        self.duration = None
+        self.reconciled = 0
+        self.unreachable = 0
+
+    def start(self):
+        self.running = True
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def answer(self, ip, location):
+        # called by handleUDP, True if the answer belongs to this reconciliation
+        with self.condition:
+            name = self.waiting.pop(ip, None)
+            if name is None:
+                return False
+            self.fetching.append((name, location))
+            self.condition.notify_all()
+            return True
+
+    def run(self):
+        begin = time.monotonic()
+        snapshot = self.site.state.snapshot()
+        message = "\r\n".join([
+            'M-SEARCH * HTTP/1.1',
+            'HOST: ' + str(MCAST_GRP) + ':' + str(MCAST_PORT),
+            'MAN: "ssdp:discover"',
+            'ST: urn:diyleddevice:light',
+            'MX: 1',
+            'USER-AGENT: DiyLed/1.1 DiyLedServer/1.1', '', '']).encode('utf-8')
+        with self.condition:
+            self.waiting = dict((snapshot.lights[name].ip, name) for name in snapshot.lights
+                                if snapshot.lights[name].ip)
+        workers = [threading.Thread(target=self.fetch) for i in range(min(RECONCILE_WORKERS, len(self.waiting)))]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        for attempt in range(RECONCILE_RETRIES):
+            with self.condition:
+                ips = list(self.waiting)
+            for ip in ips:
+                try:
+                    udp.sendto(message, (ip, MCAST_PORT))
+                except OSError as e:
+                    if DEBUG:
+                        print("UDP: couldn't reach " + self.waiting.get(ip, "?") + " at " + str(ip))
+                        print(e)
+            with self.condition:
+                self.condition.wait_for(lambda: not self.waiting, RECONCILE_TIMEOUT)
+        with self.condition:
+            silent = list(self.waiting.values())
+            self.waiting = {}
+            self.fetching.extend([None] * len(workers))
+            self.condition.notify_all()
+        for name in silent:
+            self.failed(name)
+        for worker in workers:
+            worker.join()
+        with activeSite(self.site):
+            state.touch()
+        self.duration = time.monotonic() - begin
+        self.running = False
+        message = "RECONCILE: %d of %d lights of site %s reconciled in %.3fs, %d unreachable" % (
+            self.reconciled, len(snapshot.lights), self.site.name, self.duration, self.unreachable)
+        logging.info(message)
+        if DEBUG:
+            print(message)
+
+    def fetch(self):
+        while True:
+            with self.condition:
+                while not self.fetching:
+                    self.condition.wait()
+                item = self.fetching.popleft()
+            if item is None:
+                return
+            name, location = item
+            try:
+                response = getRequests().get(location, timeout=RECONCILE_TIMEOUT)
+                conf = jsonLoads(response.content)
+                with activeSite(self.site), trace("reconcile", light=name):
+                    handleRequest(conf, None, ISUDP=True)
+                    pushGroups([conf["data"]["name"]])
+                with self.condition:
+                    self.reconciled = self.reconciled + 1
+            except Exception as e:
+                if DEBUG:
+                    print("RECONCILE: couldn't fetch the state of " + name)
+                    print(e)
+                self.failed(name)
+
+    def failed(self, name):
+        with activeSite(self.site):
+            light = state.lights.get(name)
+            if light is not None:
+                light.failures = light.failures + 1
+                lightIndex.update(light)
+                state.touch()
+        with self.condition:
+            self.unreachable = self.unreachable + 1
+
+    def getMetrics(self):
+        return {"running": self.running, "duration": self.duration, "reconciled": self.reconciled,
+                "unreachable": self.unreachable}
 
 def searchForDevices():
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -1117,57 +3981,799 @@ def searchForDevices():
         'USER-AGENT: DiyLed/1.1 DiyLedServer/1.1', '', ''])
     sock.sendto(message.encode('utf-8'), (MCAST_GRP, MCAST_PORT))
 
-def searchTimer():
-    timer = 0
-    while (timer < 30):
-        time.sleep(1)
-        timer = timer + 1
-    searching = False
+def startSearch():
+    site = currentSite()
+    if not site.searching:
+        site.newLights = []
+    site.searching = True
+    scheduler.cancel(site.searchWindow)
+    site.searchWindow = scheduler.callLater(SEARCH_WINDOW, finishSearch)
+    for i in range(SEARCH_RETRIES):
+        scheduler.callLater(i * SEARCH_RETRY_INTERVAL, searchForDevices)
+
+def finishSearch():
+    site = currentSite()
+    site.searching = False
+    site.searchWindow = None
 
     jsonData = {
         "id": "discoverResultPacket",
         "data": {
-            "lights": newLights,
+            "lights": site.newLights,
             "id": hex(get_mac())
         }
     }
     print(str(jsonData))
-    for app in appInstances:
-        if (appInstances[app].DISCOVER):
-            appInstances[app].sendMessage(json.dumps(jsonData))
-            appInstances[app].DISCOVER = False
+    events.publish("discover", {"lights": site.newLights})
+    payload = jsonDumps(jsonData)
+    snapshot = state.snapshot()
+    apps = []
+    for app in snapshot.appInstances:
+        if (snapshot.appInstances[app].DISCOVER):
+            apps.append(snapshot.appInstances[app])
+            snapshot.appInstances[app].DISCOVER = False
+    appNotifier.send(payload, apps)
 
-config = Config("config.json")
-lights = config.getLights()
-rooms = config.getRooms()
-scenes = config.getScenes()
+def notifyApps(exceptIp=None):
+    jsonData = {
+        "id": "getSetupPackets"
+    }
+    payload = jsonDumps(jsonData)
+    snapshot = state.snapshot()
+    apps = [app for app in snapshot.appInstances.values() if not app.DEAD and app.ip != exceptIp]
+    with span("notify", apps=len(apps)):
+        appNotifier.send(payload, apps)
 
-newLights = []
-searching = False
+class Site():
+    # one home: its own config, state, journal, indexes, event channel and apps. Sockets, the scheduler,
+    # the event thread and the http threads are shared by all sites of the process
+    def __init__(self, name, configPath, databasePath, journalPath, prefix="", hosts=()):
+        self.name = name
+        self.configPath = configPath
+        self.databasePath = databasePath
+        self.journalPath = journalPath
+        self.prefix = prefix  # path the site is announced with, it is always reachable under /site/<name>
+        self.hosts = [host.lower() for host in hosts]
+        self.usnSuffix = ""
+        self.config = None
+        self.state = None
+        self.journal = None
+        self.lightIndex = None
+        self.outbox = None
+        self.history = None
+        self.requestCache = RequestCache()
+        self.events = EventChannel(eventStream)
+        self.statusPage = StatusPage(self)
+        self.newLights = []
+        self.searching = False
+        self.searchWindow = None
+        self.reconciliation = None
+        self.counterLock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
 
-if DEBUG:
-    print("  -> " + str(len(lights)) + " lights")
-    print("  -> " + str(len(rooms)) + " rooms")
-    print("  -> " + str(len(scenes)) + " scenes")
-    print("- Variable setup complete")
+    def setup(self):
+        # has to run with the site active, the config classes work on the site globals
+        for path in (self.configPath, self.databasePath, self.journalPath):
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        if STORAGE == "sqlite":
+            self.config = SQLiteConfig(self.databasePath, self.configPath)
+        else:
+            self.config = Config(self.configPath)
+        self.state = StateStore()
+        self.journal = StateJournal(self.journalPath)
+        self.outbox = LightOutbox(os.path.splitext(self.journalPath)[0] + ".outbox")
+        self.outbox.load()
+        self.history = StateHistory(os.path.splitext(self.journalPath)[0] + ".history")
+        self.history.load()
+        restored = self.load(self.journal.replay)
+        # lights removed while the history file didn't free their slots yet
+        self.history.remove([name for name in list(self.history.slots) if name not in self.state.lights])
+        for name in self.state.lights:
+            self.history.record(self.state.lights[name])
+        return restored
 
-if __name__ == "__main__":
-    if DEBUG:
-        print("+ Starting subservers")
-    startUDPServer()
-    startHTMLServer()
-    t = threading.Thread(target=handleUDP)
-    t.daemon = True
-    t.start()
-    if DEBUG:
-        print("- Starting subservers")
-        print("Searching for devices")
-    searchForDevices()
-    searchForDevices()
+    def load(self, restore):
+        self.state.replace("lights", self.config.getLights())
+        restored = restore(self.state.lights)
+        for name in self.state.lights:
+            # the journal changed the lights after they were created, the rooms below count the restored values
+            self.state.lights[name].counted = self.state.lights[name].getContribution()
+        self.lightIndex = LightIndex()
+        for name in self.state.lights:
+            self.lightIndex.update(self.state.lights[name])
+        self.state.replace("rooms", self.config.getRooms())
+        self.state.replace("scenes", self.config.getScenes())
+        self.state.replace("schedules", self.config.getSchedules())
+        return restored
 
-    while True:
+    def restore(self, data):
+        # replaces config and light states with a snapshot of the primary
+        records = data["lights"]
+        with activeSite(self), self.state.lock:
+            self.disarm()
+            self.config.replaceData(data["config"])
+            self.load(lambda cLights: len([record for record in records if applyLightRecord(cLights, record)]))
+            self.journal.compact(self.state.lights, force=True)
+        self.events.publish("reset", {})
+
+    def disarm(self):
+        for name in self.state.schedules:
+            self.state.schedules[name].disarm()
+
+    def start(self):
+        for name in self.state.schedules:
+            try:
+                self.state.schedules[name].arm()
+            except (ValueError, TypeError) as e:
+                # a broken schedule in the config must not keep the server from starting
+                logging.error("SCHEDULER: couldn't arm schedule " + name + " of site " + self.name + ": " + str(e))
+                if DEBUG:
+                    print("SCHEDULER: couldn't arm schedule " + name)
+                    print(e)
+        scheduler.callLater(JOURNAL_COMPACT_INTERVAL, self.journal.compactPeriodically)
+        scheduler.callLater(HISTORY_ARCHIVE_INTERVAL, self.history.archivePeriodically)
+        scheduler.callLater(APP_SWEEP_INTERVAL, sweepApps)
+        self.reconciliation = Reconciliation(self)
+        self.reconciliation.start()
+
+    def countRequest(self):
+        with self.counterLock:
+            self.requests = self.requests + 1
+
+    def countError(self):
+        with self.counterLock:
+            self.errors = self.errors + 1
+
+    def getMetrics(self):
+        snapshot = self.state.snapshot()
+        return {
+            "name": self.name,
+            "prefix": self.prefix or "/site/" + self.name,
+            "hosts": self.hosts,
+            "lights": len(snapshot.lights),
+            "rooms": len(snapshot.rooms),
+            "scenes": len(snapshot.scenes),
+            "apps": len(snapshot.appInstances),
+            "requests": self.requests,
+            "errors": self.errors,
+            "subscribers": self.events.count(),
+            "requestCache": self.requestCache.getMetrics()
+        }
+
+
+class SiteAttribute():
+    # stands in for a per-site global (config, state ...) and forwards to the site of the current thread
+    __slots__ = ("attribute",)
+
+    def __init__(self, attribute):
+        self.attribute = attribute
+
+    def __getattr__(self, name):
+        return getattr(getattr(currentSite(), self.attribute), name)
+
+
+config = SiteAttribute("config")
+state = SiteAttribute("state")
+journal = SiteAttribute("journal")
+lightIndex = SiteAttribute("lightIndex")
+outbox = SiteAttribute("outbox")
+requestCache = SiteAttribute("requestCache")
+history = SiteAttribute("history")
+events = SiteAttribute("events")
+statusPage = SiteAttribute("statusPage")
+
+
+def currentSite():
+    return getattr(siteContext, "site", None) or defaultSite
+
+
+@contextlib.contextmanager
+def activeSite(site):
+    previous = getattr(siteContext, "site", None)
+    siteContext.site = site
+    try:
+        yield site
+    finally:
+        siteContext.site = previous
+
+
+def siteOfLight(name, ip):
+    # a light belongs to the site that knows it under this name and ip, new lights go to a searching site
+    known = None
+    for site in list(sites.values()):
+        light = site.state.lights.get(name)
+        if light is not None:
+            if light.ip == ip:
+                return site
+            known = known or site
+    if known is not None:
+        return known
+    for site in list(sites.values()):
+        if site.searching:
+            return site
+    return defaultSite
+
+
+def loadSites(path, configPath, databasePath, journalPath):
+    # sites.json: {"sites": [{"name": ..., "config": ..., "database": ..., "journal": ..., "hosts": [...]}]}, the
+    # first site is the default one. Without it the server hosts a single site out of the usual files. Only the
+    # first site falls back to the usual files, the others default to <name>/config.json ... next to them
+    global defaultSite
+    if path is not None and os.path.exists(path):
+        with open(path, "r") as file:
+            entries = json.load(file)["sites"]
+    else:
+        entries = [{"name": "default", "config": configPath, "database": databasePath, "journal": journalPath}]
+    used = {}
+    for i, entry in enumerate(entries):
+        paths = [configPath, databasePath, journalPath]
+        if i > 0:
+            directory = os.path.join(os.path.dirname(configPath), entry["name"])
+            paths = [os.path.join(directory, os.path.basename(p)) for p in paths]
+        paths = [entry.get("config", paths[0]), entry.get("database", paths[1]), entry.get("journal", paths[2])]
+        for p in paths:
+            # the outbox and history files are named after the journal, so the journal has to be unique too
+            owner = used.setdefault(os.path.abspath(p), entry["name"])
+            if owner != entry["name"]:
+                raise ValueError("sites.json: sites " + owner + " and " + entry["name"] + " both use " + p)
+        site = Site(entry["name"], paths[0], paths[1], paths[2], "" if i == 0 else "/site/" + entry["name"],
+                    entry.get("hosts", ()))
+        if i > 0:
+            site.usnSuffix = ":" + site.name
+        sites[site.name] = site
+        for host in site.hosts:
+            siteHosts[host] = site
+    defaultSite = sites[entries[0]["name"]]
+
+
+class ReplicationFollower():
+    def __init__(self, address):
+        self.address = address
+        self.condition = threading.Condition()
+        self.pending = deque()
+        self.closed = False
+
+    def push(self, entry):
+        with self.condition:
+            if len(self.pending) >= REPLICATION_BACKLOG:
+                self.closed = True  # too far behind, it starts over with a snapshot once it reconnects
+            self.pending.append(entry)
+            self.condition.notify()
+
+    def take(self, timeout):
+        with self.condition:
+            if not self.pending and not self.closed:
+                self.condition.wait(timeout)
+            entries = list(self.pending)
+            self.pending.clear()
+        return entries
+
+
+class ReplicationPrimary():
+    # streams a snapshot and then every change (create/edit/remove requests and light states) to the standbys.
+    # Request threads only append to the queues, one thread per standby does the sending
+    def __init__(self, port):
+        self.port = port
+        self.epoch = hex(random.getrandbits(48))  # tells a standby whether it knows our sequence numbers
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.backlog = deque(maxlen=REPLICATION_BACKLOG)
+        self.followers = []
+        self.listener = None
+
+    def start(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('', self.port))
+        self.listener.listen(4)
+        t = threading.Thread(target=self.accept)
+        t.daemon = True
+        t.start()
+        if DEBUG:
+            print("  -> Replication started on port " + str(self.port))
+
+    def accept(self):
+        while True:
+            sock, address = self.listener.accept()
+            t = threading.Thread(target=self.serve, args=(sock, address))
+            t.daemon = True
+            t.start()
+
+    def log(self, siteName, kind, data):
+        with self.lock:
+            self.seq = self.seq + 1
+            entry = jsonDumps({"type": kind, "seq": self.seq, "site": siteName, "time": time.time(),
+                               "data": data}) + b"\n"
+            self.backlog.append((self.seq, entry))
+            for follower in self.followers:
+                follower.push(entry)
+
+    def attach(self, follower, hello):
+        # resumes from the backlog if it still reaches back far enough, otherwise starts with a snapshot.
+        # Both happen under the state locks of every site, so no change slips in between
+        with contextlib.ExitStack() as stack:
+            for name in sites:
+                stack.enter_context(sites[name].state.lock)
+            with self.lock:
+                seq = hello.get("seq", -1)
+                if hello.get("epoch") == self.epoch and (seq == self.seq or (
+                        self.backlog and self.backlog[0][0] - 1 <= seq < self.seq)):
+                    data = b"".join(entry for entrySeq, entry in self.backlog if entrySeq > seq)
+                else:
+                    data = self.getSnapshot()
+                self.followers.append(follower)
+        return data
+
+    def getSnapshot(self):
+        data = {}
+        for name in sites:
+            snapshot = sites[name].state.snapshot()
+            data[name] = {
+                "config": sites[name].config.getData(),
+                "lights": [lightRecord(snapshot.lights[lightName]) for lightName in snapshot.lights]
+            }
+        return jsonDumps({"type": "snapshot", "seq": self.seq, "epoch": self.epoch, "time": time.time(),
+                          "sites": data}) + b"\n"
+
+    def serve(self, sock, address):
+        follower = ReplicationFollower(address)
         try:
-            time.sleep(20)
-        except KeyboardInterrupt:
-            print("Exit")
-            sys.exit(0)
\ No newline at end of file
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.settimeout(REPLICATION_TIMEOUT)
+            hello = jsonLoads(sock.makefile("rb").readline())
+            if DEBUG:
+                print("REPLICATION: standby " + str(address) + " connected at " + str(hello.get("seq")))
+            sock.sendall(self.attach(follower, hello))
+            while not follower.closed:
+                entries = follower.take(REPLICATION_HEARTBEAT)
+                if not entries:
+                    entries = [jsonDumps({"type": "heartbeat", "seq": self.seq, "time": time.time()}) + b"\n"]
+                sock.sendall(b"".join(entries))
+        except (OSError, ValueError) as e:
+            if DEBUG:
+                print("REPLICATION: lost standby " + str(address))
+                print(e)
+        finally:
+            with self.lock:
+                if follower in self.followers:
+                    self.followers.remove(follower)
+            sock.close()
+
+    def getMetrics(self):
+        with self.lock:
+            followers = [{"address": follower.address[0], "pending": len(follower.pending)}
+                         for follower in self.followers]
+        return {"role": "primary", "port": self.port, "epoch": self.epoch, "seq": self.seq, "standbys": followers}
+
+
+class ReplicationStandby():
+    # follows a primary and applies its changes to the own state, takes over once the primary stays silent
+    def __init__(self, address, takeover):
+        self.address = address
+        self.takeover = takeover
+        self.following = True
+        self.epoch = None
+        self.applied = 0
+        self.primarySeq = 0
+        self.lastHeard = time.monotonic()
+        self.lags = deque(maxlen=1000)  # seconds from the change on the primary until it was applied here
+        self.entries = 0
+        self.snapshots = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.follow()
+            except (OSError, ValueError) as e:
+                if DEBUG:
+                    print("REPLICATION: primary " + str(self.address) + " not reachable")
+                    print(e)
+            if time.monotonic() - self.lastHeard > REPLICATION_TIMEOUT:
+                logging.warning("REPLICATION: no heartbeat from " + str(self.address) + " for " + str(
+                    REPLICATION_TIMEOUT) + "s, taking over")
+                self.following = False
+                self.takeover()
+                return
+            time.sleep(REPLICATION_HEARTBEAT)
+
+    def follow(self):
+        with socket.create_connection(self.address, timeout=REPLICATION_TIMEOUT) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(jsonDumps({"type": "hello", "epoch": self.epoch, "seq": self.applied}) + b"\n")
+            file = sock.makefile("rb")
+            while True:
+                line = file.readline()
+                if not line:
+                    return
+                self.lastHeard = time.monotonic()
+                self.apply(jsonLoads(line))
+
+    def apply(self, entry):
+        if entry["type"] == "heartbeat":
+            self.primarySeq = entry["seq"]
+            return
+        if entry["type"] == "snapshot":
+            self.epoch = entry["epoch"]
+            for name in entry["sites"]:
+                if name in sites:
+                    sites[name].restore(entry["sites"][name])
+            self.snapshots = self.snapshots + 1
+            if DEBUG:
+                print("REPLICATION: applied snapshot at " + str(entry["seq"]))
+        elif entry["site"] in sites:
+            try:
+                with activeSite(sites[entry["site"]]):
+                    if entry["type"] == "request":
+                        handleRequest(entry["data"], None, ISUDP=True)
+                    elif entry["type"] == "light":
+                        light = state.lights.get(entry["data"][0])
+                        if light is not None:
+                            applyLightRecord(state.lights, entry["data"])
+                            lightChanged(light)
+            except Exception as e:
+                logging.exception("REPLICATION: couldn't apply change " + str(entry["seq"]))
+            self.lags.append(time.time() - entry["time"])
+            self.entries = self.entries + 1
+        self.applied = entry["seq"]
+        self.primarySeq = max(self.primarySeq, entry["seq"])
+
+    def getMetrics(self):
+        lags = sorted(self.lags)
+        return {
+            "role": "standby" if self.following else "primary (took over)",
+            "primary": "%s:%d" % self.address,
+            "applied": self.applied,
+            "behind": self.primarySeq - self.applied,
+            "entries": self.entries,
+            "snapshots": self.snapshots,
+            "silence": time.monotonic() - self.lastHeard,
+            "lag": {
+                "last": self.lags[-1],
+                "avg": sum(lags) / len(lags),
+                "p99": lags[min(len(lags) - 1, int(len(lags) * 0.99))],
+                "max": lags[-1]
+            } if lags else None
+        }
+
+
+def replicate(kind, data):
+    if replication is None:
+        return
+    deferred = getattr(siteContext, "deferred", None)
+    if deferred is not None:
+        deferred.append((kind, data))
+        return
+    replication.log(currentSite().name, kind, data)
+
+
+@contextlib.contextmanager
+def replicatedRequest(jsonData):
+    # a standby applies the same request to its own state, the light states it changed follow it so the
+    # standby ends up with the values of the primary
+    if replication is None:
+        yield
+        return
+    siteContext.deferred = []
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        deferred = siteContext.deferred
+        siteContext.deferred = None
+        if succeeded:
+            replicate("request", jsonData)
+        for kind, data in deferred:
+            replicate(kind, data)
+
+
+def getReplicationMetrics():
+    metrics = {"role": "single"}
+    if standby is not None:
+        metrics = standby.getMetrics()
+    if replication is not None:
+        metrics["replication"] = replication.getMetrics()
+    return metrics
+
+
+class Server():
+    def __init__(self, configPath="config.json", databasePath="config.db", journalPath="state.journal", port=80,
+                 sitesPath="sites.json", replicationPort=None, primaryAddress=None, traceRate=TRACE_SAMPLE_RATE,
+                 traceFile=TRACE_FILE, workers=HTTP_WORKERS):
+        self.configPath = configPath
+        self.databasePath = databasePath
+        self.journalPath = journalPath
+        self.sitesPath = sitesPath
+        self.replicationPort = replicationPort
+        self.primaryAddress = primaryAddress  # (host, port) of the primary to follow as a standby
+        self.traceRate = traceRate
+        self.traceFile = traceFile
+        self.workers = workers
+        self.port = port
+        self.processStartTime = getProcessStartTime()
+        self.setupTime = None
+        self.startTime = None
+        self.firstStatusTime = None
+
+    def setup(self):
+        global scheduler
+        global eventStream
+        global frameStream
+        global appNotifier
+        global tracer
+        begin = time.time()
+        if DEBUG:
+            print("*------------------------------------------------*")
+            print("Starting server")
+            print("")
+            print("+ Setting up variables")
+        scheduler = Scheduler()
+        eventStream = EventStream()
+        frameStream = FrameStream()
+        appNotifier = AppNotifier()
+        tracer = Tracer(self.traceRate, self.traceFile)
+        loadSites(self.sitesPath, self.configPath, self.databasePath, self.journalPath)
+        for name in sites:
+            with activeSite(sites[name]):
+                restored = sites[name].setup()
+                if DEBUG:
+                    print("  site " + name)
+                    print("  -> " + str(len(state.lights)) + " lights")
+                    print("  -> " + str(len(state.rooms)) + " rooms")
+                    print("  -> " + str(len(state.scenes)) + " scenes")
+                    print("  -> " + str(len(state.schedules)) + " schedules")
+                    print("  -> " + str(restored) + " light states restored")
+        self.setupTime = time.time() - begin
+        if DEBUG:
+            print("- Variable setup complete")
+
+    def start(self):
+        global standby
+        begin = time.time()
+        if DEBUG:
+            print("+ Starting subservers")
+        eventStream.start()
+        startHTMLServer(self.port, self.workers)
+        if self.primaryAddress is not None:
+            # a standby only serves its status pages until it takes over
+            standby = ReplicationStandby(self.primaryAddress, self.takeover)
+            standby.start()
+            self.startTime = time.time() - begin
+            if DEBUG:
+                print("- Following primary %s:%d" % self.primaryAddress)
+            return
+        self.startServices()
+        self.startTime = time.time() - begin
+        if DEBUG:
+            print("- Starting subservers")
+            print("  -> setup %.3fs, start %.3fs, %.3fs since process start" % (
+                self.setupTime, self.startTime, time.time() - self.processStartTime))
+            print("Searching for devices")
+        with activeSite(defaultSite):
+            startSearch()  # the search is multicast, lights other sites don't know yet end up in the default site
+
+    def startServices(self):
+        global replication
+        scheduler.start()
+        if self.replicationPort is not None:
+            replication = ReplicationPrimary(self.replicationPort)
+            replication.start()
+        startUDPServer()
+        appNotifier.start()
+        frameStream.start()
+        t = threading.Thread(target=handleUDP)
+        t.daemon = True
+        t.start()
+        for name in sites:
+            with activeSite(sites[name]):
+                sites[name].start()
+
+    def takeover(self):
+        begin = time.time()
+        for name in sites:
+            # timers armed while following are stale, start() arms everything again
+            sites[name].disarm()
+        self.startServices()
+        with activeSite(defaultSite):
+            startSearch()
+        logging.warning("REPLICATION: took over as primary in %.3fs" % (time.time() - begin))
+
+    def firstStatusServed(self):
+        if self.firstStatusTime is not None:
+            return
+        self.firstStatusTime = time.time() - self.processStartTime
+        message = "STARTUP: first /diyledstatus served %.3fs after process start (setup %.3fs, start %.3fs)" % (
+            self.firstStatusTime, self.setupTime, self.startTime)
+        if self.firstStatusTime > STARTUP_BUDGET:
+            logging.warning(message + ", budget is %.1fs" % STARTUP_BUDGET)
+        else:
+            logging.info(message)
+        if DEBUG:
+            print(message)
+
+    def run(self):
+        while True:
+            try:
+                time.sleep(20)
+            except KeyboardInterrupt:
+                print("Exit")
+                sys.exit(0)
+
+def benchmarkCodecs(rounds=1000):
+    # compares the codecs on the setupPackets of the loaded config, which is what every app gets on startup
+    # the same functions jsonDumps and jsonLoads use, with and without orjson
+    codecs = [("json", jsonDumpsFallback, jsonLoadsFallback)]
+    if orjson is not None:
+        codecs.append(("orjson", orjson.dumps, orjson.loads))
+    packets = getSetupPackets(state.snapshot(), hex(get_mac()))
+    print("setupPackets of " + str(len(state.lights)) + " lights, " + str(len(state.rooms)) + " rooms, " + str(
+        len(state.scenes)) + " scenes, " + str(rounds) + " rounds")
+    for name, dumps, loads in codecs:
+        payload = dumps(packets)
+        begin = time.perf_counter()
+        for i in range(rounds):
+            dumps(packets)
+        dumpTime = (time.perf_counter() - begin) / rounds
+        begin = time.perf_counter()
+        for i in range(rounds):
+            loads(payload)
+        loadTime = (time.perf_counter() - begin) / rounds
+        print("  %-7s %7d bytes  dumps %8.1fus  loads %8.1fus" % (name, len(payload), dumpTime * 1e6, loadTime * 1e6))
+
+def stressStateStore(seconds=10, writers=4, readers=4):
+    # concurrent writers (registrations, rooms, memberships, removals) against readers (info and setup packets,
+    # status page) on a throwaway site. Fails on any error, on a snapshot that changed while it was read and on
+    # rooms and lights that disagree about their membership or the room counts afterwards
+    with tempfile.TemporaryDirectory() as directory:
+        stressServer = Server(os.path.join(directory, "config.json"), os.path.join(directory, "config.db"),
+                              os.path.join(directory, "state.journal"), sitesPath=None, traceRate=0)
+        stressServer.setup()
+        site = defaultSite
+        stop = threading.Event()
+        errors = []
+        writes = [0] * writers  # one counter per thread
+        reads = [0] * readers
+
+        def write(n):
+            rnd = random.Random(n)
+            with activeSite(site):
+                while not stop.is_set():
+                    k = rnd.random()
+                    lightName = "L%d-%d" % (n, rnd.randrange(20))
+                    roomName = "R%d" % rnd.randrange(8)
+                    try:
+                        # the existence checks and the request happen under the writer lock, otherwise another
+                        # writer could remove the light or room in between
+                        with state.lock:
+                            if k < 0.4:
+                                handleRequest({"id": "createRequestPacket", "data": {
+                                    "request": "light", "name": lightName, "ledCount": 30, "color": [1, 2, 3],
+                                    "mode": "0", "power": rnd.random() < 0.5, "brightness": rnd.randrange(256),
+                                    "modes": ["0"], "ip": "127.0.0.1", "id": 1}}, None, ISUDP=True)
+                            elif k < 0.55:
+                                handleRequest({"id": "createRequestPacket", "data": {
+                                    "request": "room", "name": roomName, "id": 1}}, None, ISUDP=True)
+                            elif k < 0.8 and roomName in state.rooms:
+                                names = list(state.lights)
+                                handleRequest({"id": "editRequestPacket", "data": {
+                                    "request": "lightsOfRoom", "name": roomName,
+                                    "lights": rnd.sample(names, min(len(names), rnd.randrange(6))), "id": 1}},
+                                    None, ISUDP=True)
+                            elif 0.8 <= k < 0.9 and lightName in state.lights:
+                                handleRequest({"id": "removeRequestPacket", "data": {
+                                    "request": "light", "name": lightName, "id": 1}}, None, ISUDP=True)
+                            elif k >= 0.9 and roomName in state.rooms:
+                                handleRequest({"id": "removeRequestPacket", "data": {
+                                    "request": "room", "name": roomName, "id": 1}}, None, ISUDP=True)
+                    except Exception as e:
+                        errors.append("writer: " + repr(e))
+                    writes[n] = writes[n] + 1
+
+        def read(n):
+            version = 0
+            with activeSite(site):
+                while not stop.is_set():
+                    try:
+                        snapshot = state.snapshot()
+                        if snapshot.version < version:
+                            errors.append("reader: version went back from %d to %d" % (version, snapshot.version))
+                        version = snapshot.version
+                        # a copy of the dicts of the snapshot before the reads, the snapshot is shallow so only
+                        # the names and which object belongs to them can be compared afterwards
+                        copies = dict((kind, dict(getattr(snapshot, kind))) for kind in StateStore.KINDS)
+                        # the sleeps let the writers in while the snapshot is read, they would hardly get the GIL
+                        # in the middle of a read otherwise
+                        time.sleep(0)
+                        getSetupPackets(snapshot, hex(get_mac()))
+                        time.sleep(0)
+                        site.statusPage.renderJson(snapshot)
+                        time.sleep(0)
+                        dispatchRequest({"id": "infoRequestPacket", "data": {"request": "allRooms", "id": 1}})
+                        time.sleep(0)
+                        for kind in StateStore.KINDS:
+                            items = getattr(snapshot, kind)
+                            if items.keys() != copies[kind].keys() or any(
+                                    items[name] is not copies[kind][name] for name in copies[kind]):
+                                errors.append("reader: %s of snapshot %d changed while they were read" % (
+                                    kind, snapshot.version))
+                    except Exception as e:
+                        errors.append("reader: " + repr(e))
+                    reads[n] = reads[n] + 1
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(writers)] + [
+            threading.Thread(target=read, args=(i,)) for i in range(readers)]
+        for t in threads:
+            t.start()
+        time.sleep(seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        with activeSite(site):
+            snapshot = state.snapshot()
+            for roomName in snapshot.rooms:
+                room = snapshot.rooms[roomName]
+                on = [snapshot.lights[name] for name in room.lights if name in snapshot.lights and
+                      snapshot.lights[name].power]
+                for name in room.lights:
+                    if name not in snapshot.lights or roomName not in snapshot.lights[name].roomNames:
+                        errors.append("room " + roomName + " lists " + name + ", which doesn't list the room")
+                if room.lightsOn != len(on) or room.brightnessOn != sum(int(l.brightness) for l in on):
+                    errors.append("room " + roomName + " counts %d/%d, its lights %d/%d" % (
+                        room.lightsOn, room.brightnessOn, len(on), sum(int(l.brightness) for l in on)))
+            for name in snapshot.lights:
+                for roomName in snapshot.lights[name].rooms:
+                    if roomName not in snapshot.rooms or name not in snapshot.rooms[roomName].lightNames:
+                        errors.append("light " + name + " lists " + roomName + ", which doesn't list the light")
+            saved = Config(config.path) if STORAGE != "sqlite" else None
+            if saved is not None and (set(saved.getLights()) != set(snapshot.lights) or
+                                      set(saved.getRooms()) != set(snapshot.rooms)):
+                errors.append("config.json doesn't match the state")
+            print("%d writes, %d reads in %ds, %d lights and %d rooms left, %d errors" % (
+                sum(writes), sum(reads), seconds, len(snapshot.lights), len(snapshot.rooms), len(errors)))
+            for error in errors[:20]:
+                print("  " + error)
+    return not errors
+
+def getOption(name, default=None):
+    # value of a command line option, True if it is given without one
+    if name not in sys.argv:
+        return default
+    i = sys.argv.index(name)
+    if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith("--"):
+        return sys.argv[i + 1]
+    return True
+
+if __name__ == "__main__":
+    replicationPort = getOption("--replicate")
+    primary = getOption("--standby")
+    if primary is not None:
+        host, _, primaryPort = primary.partition(":")
+        primary = (host, int(primaryPort or REPLICATION_PORT))
+    server = Server(port=int(getOption("--port", 80)),
+                    replicationPort=REPLICATION_PORT if replicationPort is True else (
+                        int(replicationPort) if replicationPort is not None else None),
+                    primaryAddress=primary, traceRate=float(getOption("--trace-rate", TRACE_SAMPLE_RATE)),
+                    traceFile=getOption("--trace-file", TRACE_FILE),
+                    workers=int(getOption("--workers", HTTP_WORKERS)))
+    if len(sys.argv) == 3 and sys.argv[1] == "--export":
+        server.setup()
+        config.exportJson(sys.argv[2])
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == "--benchmark":
+        server.setup()
+        benchmarkCodecs(int(sys.argv[2]) if len(sys.argv) == 3 else 1000)
+        sys.exit(0)
+    if len(sys.argv) >= 2 and sys.argv[1] == "--stress":
+        DEBUG = False
+        sys.exit(0 if stressStateStore(int(sys.argv[2]) if len(sys.argv) == 3 else 10) else 1)
+    server.setup()
+    server.start()
+    server.run()
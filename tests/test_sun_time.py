@@ -0,0 +1,37 @@
+import os
+import sys
+import unittest
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import DiyLedServer  # noqa: E402
+
+
+class SunTimeTest(unittest.TestCase):
+    # (latitude, longitude, sunrise, utc offset in hours, local time of day as HH:MM, within a few minutes)
+    PLACES = {
+        "Los Angeles sunset": (34.05, -118.24, False, -7, "20:07"),
+        "Sydney sunrise": (-33.87, 151.21, True, 10, "06:59"),
+        "Berlin sunrise": (52.52, 13.40, True, 2, "04:43"),
+        "Berlin sunset": (52.52, 13.40, False, 2, "21:33"),
+        "Honolulu sunset": (21.30, -157.86, False, -10, "19:16"),
+        "Auckland sunset": (-36.85, 174.76, False, 12, "17:11"),
+    }
+
+    def test_event_falls_on_the_local_day(self):
+        day = date(2026, 6, 21)
+        for name, (latitude, longitude, rising, offset, expected) in self.PLACES.items():
+            with self.subTest(place=name):
+                local = DiyLedServer.getSunTime(day, latitude, longitude, rising) + timedelta(hours=offset)
+                self.assertEqual(local.date(), day)
+                hour, minute = expected.split(":")
+                minutes = local.hour * 60 + local.minute
+                self.assertLessEqual(abs(minutes - (int(hour) * 60 + int(minute))), 5)
+
+    def test_polar_day_has_no_sunset(self):
+        self.assertIsNone(DiyLedServer.getSunTime(date(2026, 6, 21), 78.22, 15.65, False))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import DiyLedServer  # noqa: E402
+
+
+class FakeServer():
+    # stands in for the ThreadedHTTPServer, answers every request with the path it asked for
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handled = []
+
+    def finish_request(self, sock, address):
+        request = sock.recv(4096)
+        path = request.split(b" ")[1]
+        with self.lock:
+            self.handled.append(path)
+        sock.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: " + str(len(path)).encode() + b"\r\n\r\n" + path)
+
+    def shutdown_request(self, sock):
+        sock.close()
+
+    def handle_error(self, sock, address):
+        pass
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def request(self, pool, body):
+        client, served = socket.socketpair()
+        client.settimeout(2)
+        client.sendall(body)
+        pool.submit(served, ("127.0.0.1", 0))
+        return client
+
+    def answer(self, client):
+        try:
+            return client.recv(4096)
+        finally:
+            client.close()
+
+    def test_bulk_requests_run_with_few_workers(self):
+        # status and info requests are bulk work, with fewer workers than HTTP_RESERVED_WORKERS they used to wait
+        # forever
+        for workers in (1, 2, 3):
+            with self.subTest(workers=workers):
+                pool = DiyLedServer.WorkerPool(FakeServer(), workers=workers)
+                pool.start()
+                self.assertLessEqual(pool.reserved, workers - 1)
+                answer = self.answer(self.request(pool, b"GET /diyledstatus HTTP/1.1\r\n\r\n"))
+                self.assertTrue(answer.endswith(b"/diyledstatus"))
+
+    def test_interactive_requests_run_with_one_worker(self):
+        pool = DiyLedServer.WorkerPool(FakeServer(), workers=1)
+        pool.start()
+        body = b'{"id": "changeValueRequestPacket"}'
+        answer = self.answer(self.request(pool, b"PUT /diyled HTTP/1.1\r\nContent-Length: " +
+                                          str(len(body)).encode() + b"\r\n\r\n" + body))
+        self.assertTrue(answer.endswith(b"/diyled"))
+        self.assertEqual(pool.getMetrics()["lanes"]["interactive"]["handled"], 1)
+
+    def test_many_bulk_requests_with_two_workers(self):
+        server = FakeServer()
+        pool = DiyLedServer.WorkerPool(server, workers=2)
+        pool.start()
+        clients = [self.request(pool, b"GET /diyledapp/%d HTTP/1.1\r\n\r\n" % i) for i in range(20)]
+        answers = [self.answer(client) for client in clients]
+        self.assertEqual([answer.split(b"\r\n\r\n")[1] for answer in answers],
+                         [b"/diyledapp/%d" % i for i in range(20)])
+        self.assertEqual(len(server.handled), 20)
+
+
+if __name__ == "__main__":
+    unittest.main()